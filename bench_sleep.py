@@ -0,0 +1,46 @@
+"""睡眠 CSV 分析的 micro-benchmark：比較逐列 SleepRecord 與串流累計兩種做法。
+
+用法：python bench_sleep.py [列數]
+"""
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from sleep_service import analyze_records, analyze_sleep, parse_csv
+
+
+def make_csv(rows: int) -> str:
+    """產生指定列數的假睡眠 CSV（格式同 Apple Watch 捷徑匯出）。"""
+    random.seed(0)
+    lines = ["Start,End,Duration (hr),Value,Source"]
+    t = datetime(2025, 12, 1, 23, 0, 0)
+    for _ in range(rows):
+        minutes = random.randint(1, 40)
+        end = t + timedelta(minutes=minutes)
+        value = random.choice(["Core", "Core", "REM", "Deep", "Awake"])
+        lines.append(f"{t:%Y-%m-%d %H:%M:%S},{end:%Y-%m-%d %H:%M:%S},{minutes / 60:.3f},{value},Apple Watch")
+        t = end
+    return "\n".join(lines)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    csv_data = make_csv(rows)
+
+    legacy = analyze_records(parse_csv(csv_data))
+    streaming = analyze_sleep(csv_data)
+    assert legacy == streaming, "兩種做法的結果不一致"
+
+    number = 10
+    t_legacy = timeit.timeit(lambda: analyze_records(parse_csv(csv_data)), number=number) / number
+    t_stream = timeit.timeit(lambda: analyze_sleep(csv_data), number=number) / number
+
+    print(f"{rows} 列")
+    print(f"SleepRecord + 多次掃描：{t_legacy * 1000:.1f} ms")
+    print(f"串流單次累計：        {t_stream * 1000:.1f} ms")
+    print(f"加速：{t_legacy / t_stream:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
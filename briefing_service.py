@@ -0,0 +1,189 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from dotenv import load_dotenv
+
+from weather_service import get_last_known_weather, get_weather
+from calendar_service import get_today_events_with_status
+from todoist_service import get_briefing_tasks_with_status
+from component_cache_service import cached_component, get_component
+from resilience_service import StaleDataError
+
+load_dotenv()
+
+# 同步 SDK（googleapiclient、Todoist）專用的執行緒池，避免阻塞 event loop
+SDK_MAX_WORKERS = int(os.getenv("SDK_MAX_WORKERS", "4"))
+
+# 各資料來源的個別期限（秒）
+WEATHER_TIMEOUT = float(os.getenv("WEATHER_TIMEOUT", "10"))
+CALENDAR_TIMEOUT = float(os.getenv("CALENDAR_TIMEOUT", "8"))
+TODOIST_TIMEOUT = float(os.getenv("TODOIST_TIMEOUT", "8"))
+
+# 整個 /morning 的時間預算（秒）與各階段可用的比例；三個來源同時進行，
+# Gemini 使用來源完成後剩下的時間（至少 1 - 最大來源比例）
+MORNING_BUDGET = float(os.getenv("MORNING_BUDGET", "8"))
+BUDGET_SHARES = {
+    "weather": float(os.getenv("BUDGET_SHARE_WEATHER", "0.4")),
+    "calendar": float(os.getenv("BUDGET_SHARE_CALENDAR", "0.4")),
+    "todoist": float(os.getenv("BUDGET_SHARE_TODOIST", "0.4")),
+}
+
+TODO_LIMIT = 5
+
+# 回應區塊 -> errors/timings 使用的來源名稱
+SOURCE_NAMES = {"weather": "weather", "events": "calendar", "todos": "todoist"}
+
+sdk_executor = ThreadPoolExecutor(max_workers=SDK_MAX_WORKERS, thread_name_prefix="sdk")
+
+
+async def run_sync(func, *args, **kwargs):
+    """在 SDK 執行緒池中執行同步函式。"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(sdk_executor, functools.partial(func, *args, **kwargs))
+
+
+async def _with_deadline(
+    name: str,
+    coro,
+    timeout: float,
+    fallback,
+    errors: dict,
+    timings: dict,
+    last_known=None,
+):
+    """在期限內等待單一資料來源，逾時或失敗時回傳最後已知的資料，沒有時回傳 fallback。
+
+    注意：逾時只會放棄等待，已送進執行緒池的同步呼叫仍會跑完。
+
+    Args:
+        last_known: 取得最後已知資料的 coroutine function，沒有資料時回傳 None
+    """
+    started = time.perf_counter()
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except StaleDataError as e:
+        errors[name] = e.reason
+        return e.data
+    except asyncio.TimeoutError:
+        errors[name] = f"逾時（>{timeout:g}s）"
+    except Exception as e:
+        errors[name] = str(e)
+    finally:
+        timings[name] = round(time.perf_counter() - started, 3)
+
+    if last_known is not None:
+        value = await last_known()
+        if value is not None:
+            errors[name] += "，使用先前的資料"
+            return value
+    return fallback
+
+
+async def _fetch_weather(location: str) -> dict:
+    data = await get_weather(location)
+    if "error" in data:
+        last_known = await get_last_known_weather(location)
+        if last_known is not None:
+            raise StaleDataError(last_known, data["error"])
+        # 沒有先前的資料也要記入 errors，回應才會把天氣標成 stale
+        raise RuntimeError(data["error"])
+    return data
+
+
+async def _fetch_todos() -> list[str]:
+    tasks, failure = await get_briefing_tasks_with_status(TODO_LIMIT)
+    todos = [t["content"] for t in tasks]
+    # 同步失敗時的本地資料不放進快取
+    if failure:
+        raise StaleDataError(todos, failure)
+    return todos
+
+
+async def _fetch_events() -> list[dict]:
+    events, failure = await run_sync(get_today_events_with_status)
+    if failure:
+        raise StaleDataError(events, failure)
+    return events
+
+
+async def _cached_events() -> list[dict]:
+    """今日行程，依 BRIEFING_EVENTS_TTL 快取（失敗不快取）。"""
+    return await cached_component("events", date.today().isoformat(), _fetch_events)
+
+
+async def _cached_todos() -> list[str]:
+    """今日待辦，依 BRIEFING_TODOS_TTL 快取（失敗不快取）。"""
+    return await cached_component("todos", date.today().isoformat(), _fetch_todos)
+
+
+def _source_tasks(location: str, errors: dict, timings: dict, budget: float | None) -> dict[str, asyncio.Task]:
+    """同時啟動天氣、行程、待辦三個來源，各自有期限與 fallback。"""
+    today = date.today().isoformat()
+    # key -> (coroutine, 期限, fallback, 最後已知資料)
+    sources = {
+        "weather": (
+            _fetch_weather(location),
+            WEATHER_TIMEOUT,
+            {"error": "天氣資料取得失敗"},
+            lambda: get_last_known_weather(location),
+        ),
+        "events": (
+            _cached_events(),
+            CALENDAR_TIMEOUT,
+            [],
+            lambda: get_component("events", today, allow_stale=True),
+        ),
+        "todos": (
+            _cached_todos(),
+            TODOIST_TIMEOUT,
+            [],
+            lambda: get_component("todos", today, allow_stale=True),
+        ),
+    }
+    tasks = {}
+    for key, (coro, timeout, fallback, last_known) in sources.items():
+        name = SOURCE_NAMES[key]
+        if budget is not None:
+            timeout = min(timeout, budget * BUDGET_SHARES[name])
+        tasks[key] = asyncio.ensure_future(
+            _with_deadline(name, coro, timeout, fallback, errors, timings, last_known)
+        )
+    return tasks
+
+
+async def iter_morning_data(location: str, errors: dict, timings: dict, budget: float | None = None):
+    """依完成順序逐一 yield (來源, 資料)，讓呼叫端可以先送出已就緒的區塊。
+
+    Args:
+        budget: 整體時間預算（秒），各來源的期限不超過 BUDGET_SHARES 對應的比例
+    """
+    tasks = _source_tasks(location, errors, timings, budget)
+    pending = {task: key for key, task in tasks.items()}
+    while pending:
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield pending.pop(task), task.result()
+
+
+async def gather_morning_data(location: str, budget: float | None = None) -> dict:
+    """同時取得天氣、行程與待辦，總耗時約等於最慢的單一來源。
+
+    各來源有各自的快取與 TTL，只有過期的來源會重新取得。
+
+    Returns:
+        dict，包含 weather、events、todos，各來源的 errors 與 timings，
+        以及使用了先前資料或 fallback 的區塊（stale）
+    """
+    errors: dict[str, str] = {}
+    timings: dict[str, float] = {}
+    data = {key: value async for key, value in iter_morning_data(location, errors, timings, budget)}
+    return {**data, "errors": errors, "timings": timings, "stale": stale_sections(errors)}
+
+
+def stale_sections(errors: dict) -> list[str]:
+    """由來源的錯誤紀錄找出使用了先前資料或 fallback 的回應區塊。"""
+    return [key for key, name in SOURCE_NAMES.items() if name in errors]
@@ -1,15 +1,26 @@
+import logging
 import os
-from datetime import datetime, timedelta
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
 
+import httplib2
 from dotenv import load_dotenv
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+from db_service import apply_calendar_changes, get_calendar_events_on, get_calendar_sync_state
+from resilience_service import call_upstream_sync, is_retryable
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # 如果只需要讀取，使用 readonly scope
 SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
 
@@ -17,9 +28,32 @@ SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
 CREDENTIALS_FILE = Path(__file__).parent / "credentials.json"
 TOKEN_FILE = Path(__file__).parent / "token.json"
 
+# 在 token 到期前多久於背景刷新（秒）
+TOKEN_REFRESH_MARGIN = int(os.getenv("GOOGLE_TOKEN_REFRESH_MARGIN", "300"))
 
-def get_credentials() -> Credentials:
-    """取得或刷新 Google OAuth credentials。"""
+# 要讀取的日曆（以逗號分隔），例如 "primary,xxx@group.calendar.google.com"
+CALENDAR_IDS = [
+    cid.strip() for cid in os.getenv("CALENDAR_IDS", "primary").split(",") if cid.strip()
+]
+
+# 本地日曆鏡像：多久同步一次（秒），以及保留幾天前的行程
+CALENDAR_SYNC_INTERVAL = float(os.getenv("CALENDAR_SYNC_INTERVAL", "300"))
+CALENDAR_KEEP_DAYS = int(os.getenv("CALENDAR_KEEP_DAYS", "7"))
+
+# 行程中快取的 credentials 與 service，避免每次讀 token.json 與重建 discovery client
+_lock = threading.RLock()
+_creds: Credentials | None = None
+_service = None
+_refresh_timer: threading.Timer | None = None
+# 避免多個執行緒同時同步同一份日曆
+_sync_lock = threading.Lock()
+_last_sync_report: dict = {}
+# httplib2.Http 不是 thread-safe，每個執行緒各自一個
+_thread_local = threading.local()
+
+
+def _load_credentials() -> Credentials:
+    """從 token.json 載入 credentials，必要時刷新或重新授權。"""
     creds = None
 
     # 嘗試載入已存在的 token
@@ -41,55 +75,281 @@ def get_credentials() -> Credentials:
             creds = flow.run_local_server(port=0)
 
         # 儲存 token 供下次使用
-        with open(TOKEN_FILE, "w") as token:
-            token.write(creds.to_json())
+        _save_token(creds)
 
     return creds
 
 
-def get_today_events() -> list[dict]:
-    """取得今日行程。
+def _save_token(creds: Credentials):
+    """以先寫暫存檔再 rename 的方式原子性地寫入 token.json。"""
+    tmp_file = TOKEN_FILE.with_suffix(".json.tmp")
+    with open(tmp_file, "w") as token:
+        token.write(creds.to_json())
+    os.replace(tmp_file, TOKEN_FILE)
+
+
+def _schedule_refresh(creds: Credentials):
+    """在 token 到期前 TOKEN_REFRESH_MARGIN 秒安排背景刷新。"""
+    global _refresh_timer
+    if _refresh_timer is not None:
+        _refresh_timer.cancel()
+        _refresh_timer = None
+    if not creds.expiry or not creds.refresh_token:
+        return
+
+    # google-auth 的 expiry 是 naive UTC
+    remaining = (creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds()
+    _refresh_timer = threading.Timer(max(remaining - TOKEN_REFRESH_MARGIN, 0), _background_refresh)
+    _refresh_timer.daemon = True
+    _refresh_timer.start()
+
+
+def _background_refresh():
+    """背景刷新 token 並寫回 token.json。"""
+    with _lock:
+        if _creds is None:
+            return
+        try:
+            _creds.refresh(Request())
+            _save_token(_creds)
+        except Exception:
+            logger.exception("Google token 背景刷新失敗")
+            return
+        _schedule_refresh(_creds)
+
+
+def get_credentials() -> Credentials:
+    """取得 Google OAuth credentials（行程內快取，到期前自動刷新）。"""
+    global _creds
+    with _lock:
+        if _creds is None:
+            _creds = _load_credentials()
+            _schedule_refresh(_creds)
+        elif not _creds.valid:
+            # 背景刷新沒趕上（例如休眠後），同步刷新一次
+            _creds.refresh(Request())
+            _save_token(_creds)
+            _schedule_refresh(_creds)
+        return _creds
+
+
+def get_calendar_service():
+    """取得快取的 Calendar service，使用內建的 static discovery 文件。"""
+    global _service
+    with _lock:
+        if _service is None:
+            _service = build(
+                "calendar",
+                "v3",
+                credentials=get_credentials(),
+                static_discovery=True,
+                cache_discovery=False,
+            )
+        return _service
+
+
+def _get_http() -> AuthorizedHttp:
+    """取得目前執行緒專用的已授權 Http。"""
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = AuthorizedHttp(get_credentials(), http=httplib2.Http())
+        _thread_local.http = http
+    return http
+
+
+def _to_local_row(event: dict) -> dict:
+    """將 Calendar API 的 event 轉成本地表格的欄位。"""
+    start = event["start"].get("dateTime", event["start"].get("date"))
+
+    # 解析時間
+    if "T" in start:
+        # 換成本機時區再取日期與時間，其他時區的日曆才不會落在錯誤的日期
+        start_dt = datetime.fromisoformat(start.replace("Z", "+00:00")).astimezone()
+        start_date = start_dt.date().isoformat()
+        start_time = start_dt.strftime("%H:%M")
+        # end_date 與全天行程一樣不含當天：結束在午夜以外的時間就算到隔天，跨日行程每天都查得到
+        end = event.get("end", {}).get("dateTime")
+        end_dt = datetime.fromisoformat(end.replace("Z", "+00:00")).astimezone() if end else start_dt
+        end_day = end_dt.date() if end_dt.time() == datetime.min.time() else end_dt.date() + timedelta(days=1)
+        end_date = max(end_day.isoformat(), start_date)
+    else:
+        start_date = start
+        start_time = ""  # 全天
+        # 全天行程的 end.date 是結束隔天（不含）
+        end_date = event.get("end", {}).get("date", start)
+
+    return {
+        "event_id": event["id"],
+        "summary": event.get("summary", "（無標題）"),
+        "location": event.get("location", ""),
+        "start_date": start_date,
+        "start_time": start_time,
+        "end_date": end_date,
+        "updated": event.get("updated"),
+    }
+
+
+def _list_params(calendar_id: str, job: dict) -> dict:
+    """組出 events().list 的參數（有 sync_token 時只取增量）。"""
+    params = {"calendarId": calendar_id, "singleEvents": True, "maxResults": 2500}
+    if job["sync_token"]:
+        params["syncToken"] = job["sync_token"]
+    else:
+        # 完整同步：syncToken 不能與 timeMin 同時使用，只在第一次帶
+        time_min = datetime.now(timezone.utc) - timedelta(days=CALENDAR_KEEP_DAYS)
+        params["timeMin"] = time_min.isoformat().replace("+00:00", "Z")
+    if job["page_token"]:
+        params["pageToken"] = job["page_token"]
+    return params
+
+
+def _apply_job(calendar_id: str, job: dict, next_token: str | None) -> dict:
+    """將一份日曆收集到的變更寫入本地表格。"""
+    items = job["items"]
+    upserts = [_to_local_row(e) for e in items if e.get("status") != "cancelled"]
+    deleted_ids = [e["id"] for e in items if e.get("status") == "cancelled"]
+
+    apply_calendar_changes(
+        calendar_id,
+        upserts,
+        deleted_ids,
+        sync_token=next_token,
+        synced_at=time.time(),
+        full_sync=job["sync_token"] is None,
+        prune_before=date.today() - timedelta(days=CALENDAR_KEEP_DAYS),
+    )
+    return {
+        "full_sync": job["sync_token"] is None,
+        "upserted": len(upserts),
+        "deleted": len(deleted_ids),
+    }
+
+
+def _execute_batch(service, jobs: dict) -> dict:
+    """以一個 batch 請求取得每個日曆的下一頁，回傳 calendar_id -> (response, exception)。
+
+    batch 內個別日曆的 429 / 5xx 只會出現在 callback，這裡改為整批拋出，
+    交給 call_upstream_sync 重試並計入斷路器；其他錯誤（例如 410）留給呼叫端逐一處理。
+    """
+    responses = {}
+
+    def callback(request_id, response, exception):
+        responses[request_id] = (response, exception)
+
+    batch = service.new_batch_http_request(callback=callback)
+    for calendar_id, job in jobs.items():
+        batch.add(service.events().list(**_list_params(calendar_id, job)), request_id=calendar_id)
+    batch.execute(http=_get_http())
+
+    for _, exception in responses.values():
+        if exception is not None and is_retryable(exception):
+            raise exception
+    return responses
+
+
+def sync_calendars(calendar_ids: list[str] | None = None, force: bool = False) -> dict:
+    """以 sync token 增量同步多個日曆到本地 SQLite。
+
+    所有需要同步的日曆合併成一個 batch HTTP 請求；有下一頁或 sync token
+    失效（410）的日曆會在下一輪 batch 繼續。
 
     Returns:
-        行程列表，每個行程包含 summary, start, end
+        同步報告，包含每個日曆的結果、batch 次數與每個 batch 的耗時
     """
-    creds = get_credentials()
-    service = build("calendar", "v3", credentials=creds)
-
-    # 取得今日的時間範圍
-    now = datetime.now()
-    start_of_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    end_of_day = start_of_day + timedelta(days=1)
-
-    events_result = service.events().list(
-        calendarId="primary",
-        timeMin=start_of_day.isoformat() + "Z",
-        timeMax=end_of_day.isoformat() + "Z",
-        singleEvents=True,
-        orderBy="startTime",
-    ).execute()
-
-    events = events_result.get("items", [])
-
-    result = []
-    for event in events:
-        start = event["start"].get("dateTime", event["start"].get("date"))
-        end = event["end"].get("dateTime", event["end"].get("date"))
-
-        # 解析時間
-        if "T" in start:
-            start_dt = datetime.fromisoformat(start.replace("Z", "+00:00"))
-            start_str = start_dt.strftime("%H:%M")
-        else:
-            start_str = "全天"
+    calendar_ids = calendar_ids or CALENDAR_IDS
+    with _sync_lock:
+        now = time.time()
+        jobs = {}
+        report = {"calendars": {}, "batches": 0, "batch_elapsed": []}
+        for calendar_id in calendar_ids:
+            state = get_calendar_sync_state(calendar_id)
+            if state and not force and now - state["synced_at"] < CALENDAR_SYNC_INTERVAL:
+                report["calendars"][calendar_id] = {"skipped": True}
+                continue
+            jobs[calendar_id] = {
+                "sync_token": state["sync_token"] if state else None,
+                "page_token": None,
+                "items": [],
+            }
+
+        service = get_calendar_service()
+        started = time.perf_counter()
+        while jobs:
+            round_started = time.perf_counter()
+            responses = call_upstream_sync("google_calendar", _execute_batch, service, jobs)
+            report["batches"] += 1
+            # 同一個 batch 的回應一起回來，只有整個 batch 的耗時有意義
+            report["batch_elapsed"].append(round(time.perf_counter() - round_started, 3))
+
+            next_jobs = {}
+            for calendar_id, job in jobs.items():
+                response, exception = responses.get(calendar_id, (None, RuntimeError("batch 沒有回應")))
+                if exception is not None:
+                    # 410 Gone：sync token 過期，下一輪重新完整同步
+                    if isinstance(exception, HttpError) and exception.resp.status == 410 and job["sync_token"]:
+                        next_jobs[calendar_id] = {**job, "sync_token": None, "page_token": None, "items": []}
+                    else:
+                        report["calendars"][calendar_id] = {"error": str(exception)}
+                    continue
+
+                job["items"].extend(response.get("items", []))
+                if response.get("nextPageToken"):
+                    job["page_token"] = response["nextPageToken"]
+                    next_jobs[calendar_id] = job
+                    continue
 
-        result.append({
-            "summary": event.get("summary", "（無標題）"),
-            "start": start_str,
-            "location": event.get("location", ""),
-        })
+                result = _apply_job(calendar_id, job, response.get("nextSyncToken"))
+                report["calendars"][calendar_id] = result
+            jobs = next_jobs
 
-    return result
+        report["elapsed"] = round(time.perf_counter() - started, 3)
+        _last_sync_report.clear()
+        _last_sync_report.update(report)
+        return report
+
+
+def get_calendar_sync_stats() -> dict:
+    """取得最近一次日曆同步的報告（各日曆結果、batch 次數與耗時）。"""
+    return dict(_last_sync_report)
+
+
+def get_today_events_with_status() -> tuple[list[dict], str | None]:
+    """取得今日行程與同步失敗原因；同步失敗但本地已有資料時回傳本地的行程。
+
+    Returns:
+        (行程列表, 失敗原因)，同步成功時失敗原因為 None
+    """
+    failure = None
+    try:
+        report = sync_calendars()
+    except Exception as e:
+        report = {"calendars": {calendar_id: {"error": str(e)} for calendar_id in CALENDAR_IDS}}
+    for calendar_id, result in report["calendars"].items():
+        if "error" not in result:
+            continue
+        # 同步失敗時，若本地已有資料就先用本地的
+        if not get_calendar_sync_state(calendar_id):
+            raise RuntimeError(f"日曆 {calendar_id} 同步失敗：{result['error']}")
+        failure = f"日曆 {calendar_id} 同步失敗，使用先前的資料：{result['error']}"
+
+    events = [
+        {
+            "summary": row["summary"],
+            "start": row["start_time"] or "全天",
+            "location": row["location"],
+        }
+        for row in get_calendar_events_on(date.today(), CALENDAR_IDS)
+    ]
+    return events, failure
+
+
+def get_today_events() -> list[dict]:
+    """取得今日行程（合併所有設定的日曆，從本地同步的資料讀取）。
+
+    Returns:
+        依時間排序的行程列表，每個行程包含 summary, start, location
+    """
+    return get_today_events_with_status()[0]
 
 
 def format_events_for_prompt(events: list[dict]) -> str:
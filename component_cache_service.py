@@ -0,0 +1,127 @@
+"""早安 briefing 的元件快取：天氣以外的各區塊（行程、待辦、AI 摘要、完整回應）各自有 key 與 TTL。
+
+行程內的 LRU 在前、SQLite component_cache 在後，重啟後與多個 worker 之間可共用。
+失效時遞增 cache_generation，其他 worker 最多 COMPONENT_CACHE_CHECK_INTERVAL 秒後就會清空記憶體層。
+天氣由 weather_service 自己的快取負責（依地點，WEATHER_CACHE_TTL）。
+"""
+import os
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from db_service import (
+    bump_cache_generation,
+    delete_component_cache,
+    get_cache_generation,
+    get_component_cache,
+    run_read,
+    run_write,
+    save_component_cache,
+)
+
+load_dotenv()
+
+# 各元件的 TTL（秒）
+COMPONENT_TTLS = {
+    "events": float(os.getenv("BRIEFING_EVENTS_TTL", "300")),
+    "todos": float(os.getenv("BRIEFING_TODOS_TTL", "120")),
+    "summary": float(os.getenv("BRIEFING_SUMMARY_TTL", "86400")),
+    "response": float(os.getenv("BRIEFING_RESPONSE_TTL", "60")),
+}
+
+COMPONENT_CACHE_MEMORY_SIZE = int(os.getenv("COMPONENT_CACHE_MEMORY_SIZE", "256"))
+# 多久向 SQLite 確認一次世代編號（秒），0 表示每次都確認
+COMPONENT_CACHE_CHECK_INTERVAL = float(os.getenv("COMPONENT_CACHE_CHECK_INTERVAL", "1"))
+
+GENERATION_KEY = "component"
+
+_memory: OrderedDict[tuple[str, str], tuple[object, float]] = OrderedDict()
+_generation = 0
+_checked_at = float("-inf")
+_stats: dict[str, dict[str, int]] = {}
+
+
+def _count(component: str, field: str):
+    counts = _stats.setdefault(component, {"memory_hits": 0, "db_hits": 0, "misses": 0})
+    counts[field] += 1
+
+
+def _remember(cache_key: tuple[str, str], value, expires_at: float):
+    _memory[cache_key] = (value, expires_at)
+    _memory.move_to_end(cache_key)
+    while len(_memory) > COMPONENT_CACHE_MEMORY_SIZE:
+        _memory.popitem(last=False)
+
+
+async def _check_generation():
+    """節流地比對世代編號，其他 worker 失效過快取時清空記憶體層。"""
+    global _generation, _checked_at
+    now = time.monotonic()
+    if now - _checked_at < COMPONENT_CACHE_CHECK_INTERVAL:
+        return
+    _checked_at = now
+    generation = await run_read(get_cache_generation, GENERATION_KEY)
+    if generation != _generation:
+        _memory.clear()
+        _generation = generation
+
+
+async def get_component(component: str, key: str, allow_stale: bool = False):
+    """取得未過期的元件快取，沒有時回傳 None。
+
+    Args:
+        allow_stale: 也接受已過期的資料（逾時 fallback 用的最後已知資料）
+    """
+    await _check_generation()
+    cache_key = (component, key)
+    entry = _memory.get(cache_key)
+    if entry is not None:
+        if allow_stale or entry[1] > time.time():
+            _memory.move_to_end(cache_key)
+            _count(component, "memory_hits")
+            return entry[0]
+
+    row = await run_read(get_component_cache, component, key)
+    if row is None or (not allow_stale and row["expires_at"] <= time.time()):
+        _count(component, "misses")
+        return None
+    _count(component, "db_hits")
+    _remember(cache_key, row["data"], row["expires_at"])
+    return row["data"]
+
+
+async def set_component(component: str, key: str, value, ttl: float | None = None):
+    """寫入元件快取（記憶體層與 SQLite）。"""
+    expires_at = time.time() + (COMPONENT_TTLS[component] if ttl is None else ttl)
+    _remember((component, key), value, expires_at)
+    await run_write(save_component_cache, component, key, value, expires_at)
+
+
+async def cached_component(component: str, key: str, factory):
+    """有快取就回傳快取，否則執行 factory()（coroutine function）並寫入快取。"""
+    value = await get_component(component, key)
+    if value is not None:
+        return value
+    value = await factory()
+    await set_component(component, key, value)
+    return value
+
+
+async def invalidate_component(component: str, key_prefix: str | None = None) -> dict:
+    """刪除元件快取並通知所有 worker 清空記憶體層。"""
+    global _generation
+    deleted = await run_write(delete_component_cache, component, key_prefix)
+    _generation = await run_write(bump_cache_generation, GENERATION_KEY)
+    _memory.clear()
+    return {"component": component, "deleted": deleted, "generation": _generation}
+
+
+def get_component_cache_stats() -> dict:
+    """各元件的命中統計。"""
+    return {
+        "ttls": COMPONENT_TTLS,
+        "components": _stats,
+        "memory_size": len(_memory),
+        "generation": _generation,
+    }
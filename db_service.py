@@ -1,10 +1,36 @@
+import asyncio
+import os
 import sqlite3
-from datetime import datetime, date
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, date, timedelta
 from pathlib import Path
 from contextlib import contextmanager
 
 DB_PATH = Path(__file__).parent / "data" / "assistant.db"
 
+# 連線參數：mmap 與 page cache 大小、等待其他 worker 釋放鎖的時間
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))
+# 每個連線保留的 prepared statement 數量
+DB_CACHED_STATEMENTS = 256
+# 查詢用的執行緒數（WAL 下讀取可與寫入同時進行）
+DB_READ_WORKERS = int(os.getenv("DB_READ_WORKERS", "4"))
+
+# 每個執行緒一條長駐連線（sqlite3 連線不能跨執行緒共用）
+_local = threading.local()
+
+# async API 專用的 DB 執行緒，查詢與寫入都不在 event loop 上執行：
+# 寫入只有一條執行緒（group commit），查詢另有執行緒池，不必排在 commit 後面
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+_read_executor = ThreadPoolExecutor(max_workers=DB_READ_WORKERS, thread_name_prefix="db-read")
+# 等待寫入的工作，DB 執行緒一次取走全部並以單一 transaction commit
+_pending_writes: list[tuple[Future, object, tuple, dict]] = []
+_pending_lock = threading.Lock()
+_flush_scheduled = False
+
 
 def init_db():
     """初始化資料庫，建立所需的表格。"""
@@ -42,18 +68,294 @@ def init_db():
                 created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS weather_cache (
+                location TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS calendar_events (
+                calendar_id TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                location TEXT NOT NULL DEFAULT '',
+                start_date TEXT NOT NULL,
+                start_time TEXT NOT NULL,
+                end_date TEXT NOT NULL,
+                updated TEXT,
+                PRIMARY KEY (calendar_id, event_id)
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_calendar_events_start
+            ON calendar_events (start_date, start_time)
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS calendar_sync_state (
+                calendar_id TEXT PRIMARY KEY,
+                sync_token TEXT,
+                synced_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS todoist_items (
+                id TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                due_date TEXT,
+                project_id TEXT,
+                child_order INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_todoist_items_due
+            ON todoist_items (due_date, priority)
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS todoist_sync_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                sync_token TEXT NOT NULL,
+                synced_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sleep_stats (
+                window_days INTEGER PRIMARY KEY,
+                anchor_date TEXT NOT NULL,
+                nights INTEGER NOT NULL,
+                sum_sleep_hours REAL NOT NULL,
+                sum_debt_hours REAL NOT NULL,
+                late_nights INTEGER NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sleep_uploads (
+                content_hash TEXT PRIMARY KEY,
+                analysis TEXT NOT NULL,
+                record_saved INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sleep_segments (
+                date TEXT PRIMARY KEY,
+                base_ts INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                data BLOB NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_generation (
+                name TEXT PRIMARY KEY,
+                generation INTEGER NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS component_cache (
+                component TEXT NOT NULL,
+                key TEXT NOT NULL,
+                data TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (component, key)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS flight_locks (
+                key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS last_known_good (
+                upstream TEXT NOT NULL,
+                key TEXT NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (upstream, key)
+            )
+        """)
+        # 啟動時順便清掉已過期的元件快取
+        conn.execute("DELETE FROM component_cache WHERE expires_at < ?", (time.time(),))
+        # 舊資料庫升級：第一次建立統計表時依現有紀錄重建
+        if not conn.execute("SELECT 1 FROM sleep_stats LIMIT 1").fetchone():
+            _rebuild_sleep_stats(conn)
         conn.commit()
 
 
+def _connect() -> sqlite3.Connection:
+    """建立新連線並套用 WAL 與效能相關 pragma。"""
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_CACHED_STATEMENTS,
+    )
+    conn.row_factory = sqlite3.Row
+    # WAL：讀寫互不阻塞，多個 uvicorn worker 可同時讀取
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
 @contextmanager
 def get_connection():
-    """取得資料庫連線。"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """取得目前執行緒的長駐資料庫連線。
+
+    連線會重複使用（保留 page cache 與 prepared statements），不會在離開時關閉；
+    發生例外時會 rollback 尚未 commit 的 transaction。
+    在批次寫入中則不 rollback，由 _flush_writes 以 savepoint 只回滾失敗的那一筆。
+    fork 出來的 worker 會重新建立自己的連線。
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = _connect()
+        _local.conn = conn
+        _local.pid = os.getpid()
     try:
         yield conn
-    finally:
-        conn.close()
+    except BaseException:
+        if conn.in_transaction and not getattr(_local, "in_batch", False):
+            conn.rollback()
+        raise
+
+
+@contextmanager
+def write_transaction():
+    """寫入用的連線：離開時 commit；在批次寫入中則交由批次統一 commit。"""
+    with get_connection() as conn:
+        yield conn
+        if not getattr(_local, "in_batch", False):
+            conn.commit()
+
+
+def _flush_writes():
+    """在 DB 執行緒上把目前累積的寫入合併成一個 transaction。
+
+    每筆寫入包在自己的 SAVEPOINT 裡，單筆失敗只會回滾該筆，不影響同批其他寫入。
+    """
+    global _flush_scheduled
+    with _pending_lock:
+        batch = _pending_writes[:]
+        _pending_writes.clear()
+        _flush_scheduled = False
+    if not batch:
+        return
+
+    results = []
+    with get_connection() as conn:
+        _local.in_batch = True
+        try:
+            # 外層先開 transaction，RELEASE savepoint 才不會直接 commit
+            conn.execute("BEGIN IMMEDIATE")
+            for future, func, args, kwargs in batch:
+                conn.execute("SAVEPOINT batch_write")
+                try:
+                    results.append((future, func(*args, **kwargs), None))
+                    conn.execute("RELEASE batch_write")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO batch_write")
+                    conn.execute("RELEASE batch_write")
+                    results.append((future, None, e))
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            results = [(future, None, e) for future, *_ in batch]
+        finally:
+            _local.in_batch = False
+
+    for future, result, error in results:
+        if future.cancelled():
+            continue
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+
+async def run_read(func, *args, **kwargs):
+    """在查詢執行緒池上執行查詢（每條執行緒各自的連線），不會等待進行中的寫入批次。"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_read_executor, lambda: func(*args, **kwargs))
+
+
+async def run_write(func, *args, **kwargs):
+    """排入批次寫入，等待所屬批次 commit 後回傳。
+
+    DB 執行緒忙碌時陸續送進來的寫入會合併成同一次 commit（group commit）。
+    """
+    global _flush_scheduled
+    future: Future = Future()
+    with _pending_lock:
+        _pending_writes.append((future, func, args, kwargs))
+        if not _flush_scheduled:
+            _flush_scheduled = True
+            _db_executor.submit(_flush_writes)
+    return await asyncio.wrap_future(future)
+
+
+def shutdown_db_executor():
+    """寫完尚未處理的批次後關閉 DB 執行緒與查詢執行緒池。"""
+    _read_executor.shutdown(wait=True)
+    _db_executor.submit(_flush_writes)
+    _db_executor.submit(close_connection)
+    _db_executor.shutdown(wait=True)
+
+
+def close_connection():
+    """關閉目前執行緒的資料庫連線。"""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        if _local.pid == os.getpid():
+            conn.close()
+        _local.conn = None
+
+
+UPSERT_SLEEP_RECORD_SQL = """
+    INSERT INTO sleep_records (
+        date, sleep_start, sleep_end, total_hours, actual_sleep_hours,
+        deep_hours, rem_hours, core_hours, awake_hours, awake_count,
+        sleep_efficiency, quality_score, note
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(date) DO UPDATE SET
+        sleep_start = excluded.sleep_start,
+        sleep_end = excluded.sleep_end,
+        total_hours = excluded.total_hours,
+        actual_sleep_hours = excluded.actual_sleep_hours,
+        deep_hours = excluded.deep_hours,
+        rem_hours = excluded.rem_hours,
+        core_hours = excluded.core_hours,
+        awake_hours = excluded.awake_hours,
+        awake_count = excluded.awake_count,
+        sleep_efficiency = excluded.sleep_efficiency,
+        quality_score = excluded.quality_score,
+        note = excluded.note
+"""
+
+
+def _sleep_record_params(record: dict) -> tuple:
+    return (
+        record["sleep_date"].isoformat(),
+        record["sleep_start"].isoformat(),
+        record["sleep_end"].isoformat(),
+        record["total_hours"],
+        record["actual_sleep_hours"],
+        record["deep_hours"],
+        record["rem_hours"],
+        record["core_hours"],
+        record["awake_hours"],
+        record["awake_count"],
+        record["sleep_efficiency"],
+        record["quality_score"],
+        record["note"],
+    )
 
 
 def save_sleep_record(
@@ -71,49 +373,231 @@ def save_sleep_record(
     quality_score: str,
     note: str,
 ) -> bool:
-    """儲存睡眠紀錄，若當天已有紀錄則更新。"""
+    """儲存睡眠紀錄，若當天已有紀錄則更新，並增量更新滾動統計。"""
+    record = locals()  # 參數名稱即欄位名稱
+    with write_transaction() as conn:
+        old = conn.execute(
+            "SELECT actual_sleep_hours, sleep_start FROM sleep_records WHERE date = ?",
+            (sleep_date.isoformat(),),
+        ).fetchone()
+        conn.execute(UPSERT_SLEEP_RECORD_SQL, _sleep_record_params(record))
+        _update_sleep_stats(
+            conn,
+            sleep_date,
+            new=_sleep_contribution(actual_sleep_hours, sleep_start.isoformat()),
+            old=_sleep_contribution(old["actual_sleep_hours"], old["sleep_start"]) if old else None,
+        )
+        return True
+
+
+def save_sleep_records(records: list[dict]) -> int:
+    """批次儲存多筆睡眠紀錄（單一 transaction、executemany），回傳寫入的日期數。
+
+    批次寫入後直接重建滾動統計，比逐筆增量更新便宜。
+
+    Args:
+        records: 每筆的欄位同 save_sleep_record 的參數
+    """
+    with write_transaction() as conn:
+        conn.executemany(UPSERT_SLEEP_RECORD_SQL, [_sleep_record_params(r) for r in records])
+        _rebuild_sleep_stats(conn)
+        # 同一天的多筆會互相覆蓋，回傳實際寫入的日期數
+        return len({r["sleep_date"] for r in records})
+
+
+# 滾動統計：視窗為「最新紀錄日期往前 N 天（含）」
+SLEEP_STATS_WINDOWS = (7, 30, 90)
+SLEEP_GOAL_HOURS = 7.0
+# 凌晨 02:00 ~ 11:59 之間入睡視為晚睡（sleep_start 為 ISO 格式，第 12-13 字元是小時）
+_LATE_SQL = "(CAST(substr(sleep_start, 12, 2) AS INTEGER) BETWEEN 2 AND 11)"
+
+
+def _sleep_contribution(actual_sleep_hours: float, sleep_start: str) -> tuple:
+    """單晚對統計的貢獻：(晚數, 睡眠時數, 睡眠負債, 是否晚睡)。"""
+    late = 1 if 2 <= int(sleep_start[11:13]) <= 11 else 0
+    return (1, actual_sleep_hours, max(0.0, SLEEP_GOAL_HOURS - actual_sleep_hours), late)
+
+
+def _sum_sleep_range(conn: sqlite3.Connection, start: date, end: date) -> tuple:
+    """加總日期區間（含頭尾）內各晚的貢獻。"""
+    row = conn.execute(
+        f"""
+        SELECT count(*), total(actual_sleep_hours),
+               total(max(0, ? - actual_sleep_hours)), total({_LATE_SQL})
+        FROM sleep_records WHERE date BETWEEN ? AND ?
+        """,
+        (SLEEP_GOAL_HOURS, start.isoformat(), end.isoformat()),
+    ).fetchone()
+    return tuple(row)
+
+
+def _write_sleep_stats(conn: sqlite3.Connection, window: int, anchor: date, sums: tuple):
+    conn.execute(
+        """
+        INSERT INTO sleep_stats (
+            window_days, anchor_date, nights, sum_sleep_hours, sum_debt_hours, late_nights
+        ) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(window_days) DO UPDATE SET
+            anchor_date = excluded.anchor_date,
+            nights = excluded.nights,
+            sum_sleep_hours = excluded.sum_sleep_hours,
+            sum_debt_hours = excluded.sum_debt_hours,
+            late_nights = excluded.late_nights
+        """,
+        (window, anchor.isoformat(), int(sums[0]), sums[1], sums[2], int(sums[3])),
+    )
+
+
+def _rebuild_sleep_stats(conn: sqlite3.Connection):
+    """依 sleep_records 重新計算所有視窗的統計。"""
+    row = conn.execute("SELECT max(date) FROM sleep_records").fetchone()
+    if not row[0]:
+        conn.execute("DELETE FROM sleep_stats")
+        return
+    anchor = date.fromisoformat(row[0])
+    for window in SLEEP_STATS_WINDOWS:
+        sums = _sum_sleep_range(conn, anchor - timedelta(days=window - 1), anchor)
+        _write_sleep_stats(conn, window, anchor, sums)
+
+
+def _update_sleep_stats(conn: sqlite3.Connection, sleep_date: date, new: tuple, old: tuple | None):
+    """單筆 upsert 後增量更新統計，成本與歷史資料量無關。
+
+    - 新日期比視窗最後一天還新：視窗往後滑，扣掉滑出去的天數，再加上新的一晚
+    - 日期落在視窗內：加上新值與舊值的差（更正既有紀錄）
+    - 日期比視窗還舊：不影響
+    """
+    rows = {
+        row["window_days"]: row
+        for row in conn.execute("SELECT * FROM sleep_stats").fetchall()
+    }
+    for window in SLEEP_STATS_WINDOWS:
+        row = rows.get(window)
+        if row is None:
+            _rebuild_sleep_stats(conn)
+            return
+
+        anchor = date.fromisoformat(row["anchor_date"])
+        sums = [row["nights"], row["sum_sleep_hours"], row["sum_debt_hours"], row["late_nights"]]
+        if sleep_date > anchor:
+            old_start = anchor - timedelta(days=window - 1)
+            new_start = sleep_date - timedelta(days=window - 1)
+            if new_start > old_start:
+                expired = _sum_sleep_range(conn, old_start, min(new_start - timedelta(days=1), anchor))
+                sums = [a - b for a, b in zip(sums, expired)]
+            sums = [a + b for a, b in zip(sums, new)]
+            anchor = sleep_date
+        elif sleep_date > anchor - timedelta(days=window):
+            sums = [a + b for a, b in zip(sums, new)]
+            if old:
+                sums = [a - b for a, b in zip(sums, old)]
+        else:
+            continue
+        _write_sleep_stats(conn, window, anchor, sums)
+
+
+def get_sleep_stats() -> dict:
+    """取得 7/30/90 天的滾動睡眠統計（固定時間，不掃描歷史紀錄）。"""
+    with get_connection() as conn:
+        rows = conn.execute("SELECT * FROM sleep_stats ORDER BY window_days").fetchall()
+
+    windows = {}
+    for row in rows:
+        nights = row["nights"]
+        windows[row["window_days"]] = {
+            "anchor_date": row["anchor_date"],
+            "nights": nights,
+            "avg_sleep_hours": round(row["sum_sleep_hours"] / nights, 2) if nights else None,
+            "sleep_debt_hours": round(max(row["sum_debt_hours"], 0.0), 2),
+            "late_night_ratio": round(row["late_nights"] / nights, 2) if nights else None,
+        }
+    return {"goal_hours": SLEEP_GOAL_HOURS, "windows": windows}
+
+
+def get_sleep_upload(content_hash: str) -> dict | None:
+    """取得已處理過的睡眠 CSV（以內容雜湊查詢），回傳 analysis JSON 與是否已寫入紀錄。"""
     with get_connection() as conn:
+        row = conn.execute(
+            "SELECT analysis, record_saved FROM sleep_uploads WHERE content_hash = ?",
+            (content_hash,),
+        ).fetchone()
+        if row:
+            return {"analysis": row["analysis"], "record_saved": bool(row["record_saved"])}
+        return None
+
+
+def save_sleep_upload(content_hash: str, analysis: str, record_saved: bool) -> bool:
+    """記錄睡眠 CSV 的分析結果；record_saved 一旦為真就不會被改回。"""
+    with write_transaction() as conn:
         conn.execute(
             """
-            INSERT INTO sleep_records (
-                date, sleep_start, sleep_end, total_hours, actual_sleep_hours,
-                deep_hours, rem_hours, core_hours, awake_hours, awake_count,
-                sleep_efficiency, quality_score, note
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(date) DO UPDATE SET
-                sleep_start = excluded.sleep_start,
-                sleep_end = excluded.sleep_end,
-                total_hours = excluded.total_hours,
-                actual_sleep_hours = excluded.actual_sleep_hours,
-                deep_hours = excluded.deep_hours,
-                rem_hours = excluded.rem_hours,
-                core_hours = excluded.core_hours,
-                awake_hours = excluded.awake_hours,
-                awake_count = excluded.awake_count,
-                sleep_efficiency = excluded.sleep_efficiency,
-                quality_score = excluded.quality_score,
-                note = excluded.note
+            INSERT INTO sleep_uploads (content_hash, analysis, record_saved)
+            VALUES (?, ?, ?)
+            ON CONFLICT(content_hash) DO UPDATE SET
+                analysis = excluded.analysis,
+                record_saved = max(record_saved, excluded.record_saved)
             """,
-            (
-                sleep_date.isoformat(),
-                sleep_start.isoformat(),
-                sleep_end.isoformat(),
-                total_hours,
-                actual_sleep_hours,
-                deep_hours,
-                rem_hours,
-                core_hours,
-                awake_hours,
-                awake_count,
-                sleep_efficiency,
-                quality_score,
-                note,
-            ),
+            (content_hash, analysis, int(record_saved)),
         )
-        conn.commit()
         return True
 
 
+def clear_sleep_uploads() -> int:
+    """清除所有已記錄的睡眠 CSV 分析結果（評分規則改變後舊結果已不正確），回傳筆數。"""
+    with write_transaction() as conn:
+        return conn.execute("DELETE FROM sleep_uploads").rowcount
+
+
+def count_sleep_uploads() -> int:
+    """已記錄的睡眠 CSV 數量。"""
+    with get_connection() as conn:
+        return conn.execute("SELECT count(*) FROM sleep_uploads").fetchone()[0]
+
+
+def save_sleep_segments(rows: list[tuple[str, int, int, bytes]]) -> int:
+    """批次儲存每晚壓縮後的睡眠片段（date, base_ts, count, data），回傳筆數。"""
+    with write_transaction() as conn:
+        conn.executemany(
+            """
+            INSERT INTO sleep_segments (date, base_ts, count, data)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(date) DO UPDATE SET
+                base_ts = excluded.base_ts,
+                count = excluded.count,
+                data = excluded.data
+            """,
+            rows,
+        )
+        return len(rows)
+
+
+def get_sleep_segments(sleep_date: date) -> dict | None:
+    """取得指定日期的睡眠片段。"""
+    with get_connection() as conn:
+        row = conn.execute(
+            "SELECT * FROM sleep_segments WHERE date = ?",
+            (sleep_date.isoformat(),),
+        ).fetchone()
+        return dict(row) if row else None
+
+
+def get_recent_sleep_segments(nights: int = 7) -> list[dict]:
+    """取得最近 N 晚的睡眠片段（依日期由新到舊）。"""
+    with get_connection() as conn:
+        rows = conn.execute(
+            "SELECT * FROM sleep_segments ORDER BY date DESC LIMIT ?",
+            (nights,),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+
+def get_all_sleep_segments() -> list[dict]:
+    """依日期取得所有已儲存的睡眠片段（重新評分用）。"""
+    with get_connection() as conn:
+        rows = conn.execute("SELECT * FROM sleep_segments ORDER BY date").fetchall()
+        return [dict(row) for row in rows]
+
+
 def get_sleep_record(sleep_date: date) -> dict | None:
     """取得指定日期的睡眠紀錄。"""
     with get_connection() as conn:
@@ -144,22 +628,6 @@ def get_recent_sleep_records(days: int = 7) -> list[dict]:
         return [dict(row) for row in rows]
 
 
-def get_morning_cache(cache_date: date) -> dict | None:
-    """取得指定日期的早安快取。"""
-    import json
-    with get_connection() as conn:
-        row = conn.execute(
-            "SELECT * FROM morning_cache WHERE date = ?",
-            (cache_date.isoformat(),),
-        ).fetchone()
-        if row:
-            result = dict(row)
-            result["events"] = json.loads(result["events"])
-            result["todos"] = json.loads(result["todos"])
-            return result
-        return None
-
-
 def save_morning_cache(
     cache_date: date,
     summary: str,
@@ -170,7 +638,7 @@ def save_morning_cache(
 ) -> bool:
     """儲存早安快取，若當天已有則更新。"""
     import json
-    with get_connection() as conn:
+    with write_transaction() as conn:
         conn.execute(
             """
             INSERT INTO morning_cache (date, summary, weather, events, todos, display)
@@ -191,8 +659,394 @@ def save_morning_cache(
                 display,
             ),
         )
-        conn.commit()
         return True
 
 
+def get_cache_generation(name: str) -> int:
+    """取得快取的世代編號，各 worker 以此判斷記憶體快取是否需要清除。"""
+    with get_connection() as conn:
+        row = conn.execute("SELECT generation FROM cache_generation WHERE name = ?", (name,)).fetchone()
+        return row["generation"] if row else 0
+
+
+def bump_cache_generation(name: str) -> int:
+    """將快取世代編號加一並回傳新值。"""
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO cache_generation (name, generation) VALUES (?, 1)
+            ON CONFLICT(name) DO UPDATE SET generation = generation + 1
+            """,
+            (name,),
+        )
+        return conn.execute("SELECT generation FROM cache_generation WHERE name = ?", (name,)).fetchone()[0]
+
+
+def get_component_cache(component: str, key: str) -> dict | None:
+    """取得元件快取，回傳 data 與 expires_at（不檢查是否過期）。"""
+    import json
+    with get_connection() as conn:
+        row = conn.execute(
+            "SELECT data, expires_at FROM component_cache WHERE component = ? AND key = ?",
+            (component, key),
+        ).fetchone()
+        if row:
+            return {"data": json.loads(row["data"]), "expires_at": row["expires_at"]}
+        return None
+
+
+def save_component_cache(component: str, key: str, data, expires_at: float) -> bool:
+    """儲存元件快取，已有相同 key 時覆寫。"""
+    import json
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO component_cache (component, key, data, expires_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(component, key) DO UPDATE SET
+                data = excluded.data,
+                expires_at = excluded.expires_at
+            """,
+            (component, key, json.dumps(data, ensure_ascii=False), expires_at),
+        )
+        return True
+
+
+def delete_component_cache(component: str, key_prefix: str | None = None) -> int:
+    """刪除某個元件的快取（可只刪 key 以 key_prefix 開頭的），回傳刪除筆數。"""
+    with write_transaction() as conn:
+        if key_prefix is None:
+            cursor = conn.execute("DELETE FROM component_cache WHERE component = ?", (component,))
+        else:
+            cursor = conn.execute(
+                "DELETE FROM component_cache WHERE component = ? AND substr(key, 1, ?) = ?",
+                (component, len(key_prefix), key_prefix),
+            )
+        return cursor.rowcount
+
+
+def acquire_flight_lock(key: str, owner: str, ttl: float) -> bool:
+    """嘗試取得跨 worker 的鎖；已被他人持有且未過期時回傳 False。"""
+    now = time.time()
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO flight_locks (key, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                owner = excluded.owner,
+                expires_at = excluded.expires_at
+            WHERE flight_locks.expires_at < ?
+            """,
+            (key, owner, now + ttl, now),
+        )
+        row = conn.execute("SELECT owner FROM flight_locks WHERE key = ?", (key,)).fetchone()
+        return row["owner"] == owner
+
+
+def release_flight_lock(key: str, owner: str) -> bool:
+    """釋放自己持有的鎖。"""
+    with write_transaction() as conn:
+        cursor = conn.execute("DELETE FROM flight_locks WHERE key = ? AND owner = ?", (key, owner))
+        return cursor.rowcount > 0
+
+
+def is_flight_locked(key: str) -> bool:
+    """鎖是否仍被持有且未過期。"""
+    with get_connection() as conn:
+        row = conn.execute(
+            "SELECT 1 FROM flight_locks WHERE key = ? AND expires_at >= ?",
+            (key, time.time()),
+        ).fetchone()
+        return row is not None
+
+
+def get_last_known_good(upstream: str, key: str) -> dict | None:
+    """取得外部服務最後一次成功的資料，回傳 data 與 updated_at。"""
+    import json
+    with get_connection() as conn:
+        row = conn.execute(
+            "SELECT data, updated_at FROM last_known_good WHERE upstream = ? AND key = ?",
+            (upstream, key),
+        ).fetchone()
+        if row:
+            return {"data": json.loads(row["data"]), "updated_at": row["updated_at"]}
+        return None
+
+
+def save_last_known_good(upstream: str, key: str, data) -> bool:
+    """儲存外部服務最後一次成功的資料。"""
+    import json
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO last_known_good (upstream, key, data, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(upstream, key) DO UPDATE SET
+                data = excluded.data,
+                updated_at = excluded.updated_at
+            """,
+            (upstream, key, json.dumps(data, ensure_ascii=False), time.time()),
+        )
+        return True
+
+
+def get_weather_cache(location: str) -> dict | None:
+    """取得指定地點的天氣快取，回傳 data 與 expires_at。"""
+    import json
+    with get_connection() as conn:
+        row = conn.execute(
+            "SELECT data, expires_at FROM weather_cache WHERE location = ?",
+            (location,),
+        ).fetchone()
+        if row:
+            return {"data": json.loads(row["data"]), "expires_at": row["expires_at"]}
+        return None
+
+
+def save_weather_cache(location: str, data: dict, expires_at: float) -> bool:
+    """儲存天氣快取，若已有則更新。"""
+    import json
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO weather_cache (location, data, expires_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(location) DO UPDATE SET
+                data = excluded.data,
+                expires_at = excluded.expires_at,
+                updated_at = CURRENT_TIMESTAMP
+            """,
+            (location, json.dumps(data, ensure_ascii=False), expires_at),
+        )
+        return True
+
+
+def save_weather_cache_many(items: list[tuple[str, dict, float]]) -> bool:
+    """批次儲存多個地點的天氣快取（location, data, expires_at）。"""
+    import json
+    with write_transaction() as conn:
+        conn.executemany(
+            """
+            INSERT INTO weather_cache (location, data, expires_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(location) DO UPDATE SET
+                data = excluded.data,
+                expires_at = excluded.expires_at,
+                updated_at = CURRENT_TIMESTAMP
+            """,
+            [
+                (location, json.dumps(data, ensure_ascii=False), expires_at)
+                for location, data, expires_at in items
+            ],
+        )
+        return True
+
+
+def get_calendar_sync_state(calendar_id: str) -> dict | None:
+    """取得指定日曆的同步狀態（sync_token、synced_at）。"""
+    with get_connection() as conn:
+        row = conn.execute(
+            "SELECT * FROM calendar_sync_state WHERE calendar_id = ?",
+            (calendar_id,),
+        ).fetchone()
+        return dict(row) if row else None
+
+
+def apply_calendar_changes(
+    calendar_id: str,
+    upserts: list[dict],
+    deleted_ids: list[str],
+    sync_token: str | None,
+    synced_at: float,
+    full_sync: bool = False,
+    prune_before: date | None = None,
+) -> bool:
+    """在同一個 transaction 內套用日曆變更並更新 sync token。
+
+    Args:
+        upserts: 每筆包含 event_id, summary, location, start_date, start_time, end_date（不含）, updated
+        deleted_ids: 已取消（刪除）的 event_id
+        full_sync: 完整同步時先清空該日曆的本地資料
+        prune_before: 刪除在此日期前就已結束的舊行程
+    """
+    with write_transaction() as conn:
+        if full_sync:
+            conn.execute("DELETE FROM calendar_events WHERE calendar_id = ?", (calendar_id,))
+        conn.executemany(
+            """
+            INSERT INTO calendar_events (
+                calendar_id, event_id, summary, location,
+                start_date, start_time, end_date, updated
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(calendar_id, event_id) DO UPDATE SET
+                summary = excluded.summary,
+                location = excluded.location,
+                start_date = excluded.start_date,
+                start_time = excluded.start_time,
+                end_date = excluded.end_date,
+                updated = excluded.updated
+            """,
+            [
+                (
+                    calendar_id,
+                    e["event_id"],
+                    e["summary"],
+                    e["location"],
+                    e["start_date"],
+                    e["start_time"],
+                    e["end_date"],
+                    e["updated"],
+                )
+                for e in upserts
+            ],
+        )
+        conn.executemany(
+            "DELETE FROM calendar_events WHERE calendar_id = ? AND event_id = ?",
+            [(calendar_id, event_id) for event_id in deleted_ids],
+        )
+        if prune_before:
+            conn.execute(
+                "DELETE FROM calendar_events WHERE calendar_id = ? AND end_date < ?",
+                (calendar_id, prune_before.isoformat()),
+            )
+        conn.execute(
+            """
+            INSERT INTO calendar_sync_state (calendar_id, sync_token, synced_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(calendar_id) DO UPDATE SET
+                sync_token = excluded.sync_token,
+                synced_at = excluded.synced_at
+            """,
+            (calendar_id, sync_token, synced_at),
+        )
+        return True
+
+
+def get_calendar_events_on(event_date: date, calendar_ids: list[str] | None = None) -> list[dict]:
+    """取得指定日期的本地行程（含跨日行程），全天行程在前，其餘依開始時間排序。
+
+    Args:
+        calendar_ids: 只取這些日曆，None 表示全部
+    """
+    day = event_date.isoformat()
+    query = """
+        SELECT calendar_id, event_id, summary, location, start_date, start_time
+        FROM calendar_events
+        WHERE start_date <= ? AND (start_date = ? OR end_date > ?)
+    """
+    params = [day, day, day]
+    if calendar_ids:
+        query += f" AND calendar_id IN ({', '.join('?' for _ in calendar_ids)})"
+        params.extend(calendar_ids)
+    query += " ORDER BY start_time, summary"
+
+    with get_connection() as conn:
+        rows = conn.execute(query, params).fetchall()
+        return [dict(row) for row in rows]
+
+
+def get_todoist_sync_state() -> dict | None:
+    """取得 Todoist 同步狀態（sync_token、synced_at）。"""
+    with get_connection() as conn:
+        row = conn.execute("SELECT * FROM todoist_sync_state WHERE id = 1").fetchone()
+        return dict(row) if row else None
+
+
+def apply_todoist_changes(
+    upserts: list[dict],
+    deleted_ids: list[str],
+    sync_token: str,
+    synced_at: float,
+    full_sync: bool = False,
+) -> bool:
+    """在同一個 transaction 內套用 Todoist 變更並更新 sync token。
+
+    Args:
+        upserts: 未完成的待辦，每筆包含 id, content, priority, due_date, project_id, child_order, updated_at
+        deleted_ids: 已完成或已刪除的待辦 id
+        full_sync: 完整同步時先清空本地資料
+    """
+    with write_transaction() as conn:
+        if full_sync:
+            conn.execute("DELETE FROM todoist_items")
+        conn.executemany(
+            """
+            INSERT INTO todoist_items (
+                id, content, priority, due_date, project_id, child_order, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                content = excluded.content,
+                priority = excluded.priority,
+                due_date = excluded.due_date,
+                project_id = excluded.project_id,
+                child_order = excluded.child_order,
+                updated_at = excluded.updated_at
+            """,
+            [
+                (
+                    item["id"],
+                    item["content"],
+                    item["priority"],
+                    item["due_date"],
+                    item["project_id"],
+                    item["child_order"],
+                    item["updated_at"],
+                )
+                for item in upserts
+            ],
+        )
+        conn.executemany(
+            "DELETE FROM todoist_items WHERE id = ?",
+            [(item_id,) for item_id in deleted_ids],
+        )
+        conn.execute(
+            """
+            INSERT INTO todoist_sync_state (id, sync_token, synced_at)
+            VALUES (1, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                sync_token = excluded.sync_token,
+                synced_at = excluded.synced_at
+            """,
+            (sync_token, synced_at),
+        )
+        return True
+
+
+def get_todoist_items(due_on_or_before: date | None = None, limit: int | None = None) -> list[dict]:
+    """取得本地的未完成待辦，依優先度（高到低）、到期日排序。
+
+    Args:
+        due_on_or_before: 只取到期日在此日期（含）之前的待辦
+        limit: 最多幾筆，None 表示全部
+    """
+    query = "SELECT * FROM todoist_items"
+    params: list = []
+    if due_on_or_before:
+        query += " WHERE due_date IS NOT NULL AND due_date <= ?"
+        params.append(due_on_or_before.isoformat())
+    query += " ORDER BY priority DESC, due_date IS NULL, due_date, child_order"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+
+    with get_connection() as conn:
+        rows = conn.execute(query, params).fetchall()
+        return [dict(row) for row in rows]
+
+
+async def save_sleep_record_async(*args, **kwargs) -> bool:
+    """save_sleep_record 的非同步版本（批次寫入）。"""
+    return await run_write(save_sleep_record, *args, **kwargs)
+
+
+async def get_recent_sleep_records_async(days: int = 7) -> list[dict]:
+    """get_recent_sleep_records 的非同步版本。"""
+    return await run_read(get_recent_sleep_records, days)
+
+
+async def get_sleep_stats_async() -> dict:
+    """get_sleep_stats 的非同步版本。"""
+    return await run_read(get_sleep_stats)
+
+
 init_db()
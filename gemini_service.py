@@ -1,14 +1,33 @@
+import asyncio
+import hashlib
+import json
 import os
+import time
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 
+from component_cache_service import get_component, set_component
+from resilience_service import CircuitOpenError, call_upstream, is_retryable, stream_upstream
+
 load_dotenv(override=True)  # 強制重新載入 .env
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
 client = genai.Client(api_key=GEMINI_API_KEY)
 
+# 人設與指示放進 Gemini 的 context cache，每次請求只送當天的資料；
+# 預設關閉：目前的人設遠低於各模型明確快取的最小 token 數。
+# 快取在背景建立，還沒建好或建立失敗時改用 system_instruction，不會拖慢請求
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "false").lower() in ("1", "true", "yes")
+# 模型的最小快取 token 數，系統指示低於此數時不建立
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+# 到期前多久重新建立（秒）
+GEMINI_CONTEXT_CACHE_REFRESH_MARGIN = int(os.getenv("GEMINI_CONTEXT_CACHE_REFRESH_MARGIN", "300"))
+# 建立失敗後多久再試一次（秒）
+GEMINI_CONTEXT_CACHE_RETRY = int(os.getenv("GEMINI_CONTEXT_CACHE_RETRY", "3600"))
+
 PERSONAL_CONTEXT = """
 你是我的個人助理，負責每天早上給我簡短的 briefing。
 
@@ -26,8 +45,41 @@ PERSONAL_CONTEXT = """
 - 不要說「早安」或打招呼
 """
 
+INSTRUCTIONS = """
+每次我會提供今日天氣、行程、睡眠與待辦，根據這些資訊給我一段早安提醒（50 字內），重點放在：
+1. 天氣提醒（需要帶傘、注意溫差等）
+2. 今日行程提醒（有重要會議或活動時提）
+3. 睡眠狀況評價（只在明顯有問題時提）
+4. 今天最該優先處理的事
+"""
 
-async def generate_morning_message(
+SYSTEM_INSTRUCTION = PERSONAL_CONTEXT + INSTRUCTIONS
+
+THINKING_CONFIG = types.ThinkingConfig(thinking_budget=0)
+
+_context = {"name": None, "expires_at": 0.0, "retry_at": 0.0, "error": None, "created": 0, "tokens": None}
+# 背景建立中的 context cache（保留參照避免被回收）
+_context_task: asyncio.Task | None = None
+
+# 各路徑的呼叫次數、token 用量與延遲：context_cache、system_instruction、summary_cache（命中摘要快取）
+_stats = {
+    path: {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "latency": 0.0}
+    for path in ("context_cache", "system_instruction", "summary_cache")
+}
+
+
+def summary_key(**inputs) -> str:
+    """以模型、系統指示與正規化後的輸入計算摘要快取的 key。"""
+    normalized = {k: v.strip() if isinstance(v, str) else v for k, v in inputs.items()}
+    payload = json.dumps(
+        {"model": GEMINI_MODEL, "instruction": SYSTEM_INSTRUCTION, "inputs": normalized},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def build_prompt(
     sleep_time: str,
     wake_time: str,
     sleep_hours: float,
@@ -35,13 +87,13 @@ async def generate_morning_message(
     todos: list[str],
     weather: str = "",
     events: str = "",
+    trend: str = "",
 ) -> str:
-    """生成早安訊息。"""
+    """組合每天變動的部分；人設與指示在 SYSTEM_INSTRUCTION。"""
     todo_text = "\n".join(f"- {t}" for t in todos[:5]) if todos else "無待辦"
+    trend_text = f"\n【近期睡眠趨勢】\n{trend}\n" if trend else ""
 
-    prompt = f"""{PERSONAL_CONTEXT}
-
-【今日天氣】
+    return f"""【今日天氣】
 {weather}
 
 【今日行程】
@@ -52,32 +104,262 @@ async def generate_morning_message(
 - 起床：{wake_time}
 - 實際睡眠：{sleep_hours:.1f} 小時
 - 品質：{quality}
-
+{trend_text}
 【待辦事項】
 {todo_text}
-
-根據以上資訊，給我一段早安提醒（50 字內），重點放在：
-1. 天氣提醒（需要帶傘、注意溫差等）
-2. 今日行程提醒（有重要會議或活動時提）
-3. 睡眠狀況評價（只在明顯有問題時提）
-4. 今天最該優先處理的事
 """
 
-    response = await client.aio.models.generate_content(
-        model=GEMINI_MODEL,
-        contents=prompt,
-        config=types.GenerateContentConfig(
-            thinking_config=types.ThinkingConfig(thinking_budget=0),
-        ),
+
+def _message_key(sleep_time, wake_time, sleep_hours, quality, todos, weather, events, trend) -> str:
+    return summary_key(
+        sleep_time=sleep_time,
+        wake_time=wake_time,
+        sleep_hours=round(sleep_hours, 1),
+        quality=quality,
+        todos=todos[:5],
+        weather=weather,
+        events=events,
+        trend=trend,
     )
 
-    if response.text:
-        return response.text.strip()
+
+def fallback_message(sleep_time: str, wake_time: str, sleep_hours: float, quality: str) -> str:
+    """Gemini 沒有回應或來不及回應時使用的本地摘要。"""
     return f"{sleep_time} 睡、{wake_time} 起，睡 {sleep_hours:.1f}hr，品質{quality}"
 
 
+def _get_context_cache() -> str | None:
+    """取得人設的 cached content 名稱；快到期或還沒有時在背景建立，這次先回傳 None（不等待）。"""
+    if not GEMINI_CONTEXT_CACHE:
+        return None
+    now = time.time()
+    if _context["name"] and now < _context["expires_at"] - GEMINI_CONTEXT_CACHE_REFRESH_MARGIN:
+        return _context["name"]
+    if now >= _context["retry_at"]:
+        start_context_cache()
+    # 快到期但尚未過期的舊 cache 仍可使用
+    return _context["name"] if now < _context["expires_at"] else None
+
+
+def start_context_cache():
+    """在背景建立（或更新）人設的 context cache，已在進行中時不重複建立。"""
+    global _context_task
+    if not GEMINI_CONTEXT_CACHE or (_context_task is not None and not _context_task.done()):
+        return
+    _context_task = asyncio.get_running_loop().create_task(_create_context_cache())
+
+
+async def _create_context_cache():
+    now = time.time()
+    try:
+        if _context["tokens"] is None:
+            counted = await client.aio.models.count_tokens(model=GEMINI_MODEL, contents=SYSTEM_INSTRUCTION)
+            _context["tokens"] = counted.total_tokens
+        if _context["tokens"] < GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+            # 系統指示在執行期間不會變，之後也不必再試
+            _context.update(
+                retry_at=float("inf"),
+                error=f"系統指示只有 {_context['tokens']} tokens，低於最小快取 {GEMINI_CONTEXT_CACHE_MIN_TOKENS}",
+            )
+            return
+        # 舊的 cache 會在自己的 TTL 到期後消失，這裡直接建立新的
+        cache = await client.aio.caches.create(
+            model=GEMINI_MODEL,
+            config=types.CreateCachedContentConfig(
+                display_name="morning-briefing-persona",
+                system_instruction=SYSTEM_INSTRUCTION,
+                ttl=f"{GEMINI_CONTEXT_CACHE_TTL}s",
+            ),
+        )
+    except Exception as e:
+        _context.update(retry_at=now + GEMINI_CONTEXT_CACHE_RETRY, error=str(e))
+        return
+    _context.update(name=cache.name, expires_at=now + GEMINI_CONTEXT_CACHE_TTL, error=None)
+    _context["created"] += 1
+
+
+def _drop_context_cache():
+    """cached content 失效（例如被刪除）時，改用 system_instruction 並稍後重建。"""
+    _context.update(name=None, expires_at=0.0, retry_at=time.time() + GEMINI_CONTEXT_CACHE_REFRESH_MARGIN)
+
+
+def _should_retry_without_cache(cache_name: str | None, exc: Exception) -> bool:
+    """只有 cached content 本身被拒絕（4xx）時才改用 system_instruction 重送。"""
+    return cache_name is not None and not isinstance(exc, CircuitOpenError) and not is_retryable(exc)
+
+
+def _config(cache_name: str | None) -> types.GenerateContentConfig:
+    if cache_name:
+        return types.GenerateContentConfig(cached_content=cache_name, thinking_config=THINKING_CONFIG)
+    return types.GenerateContentConfig(system_instruction=SYSTEM_INSTRUCTION, thinking_config=THINKING_CONFIG)
+
+
+def _record(path: str, usage, started: float):
+    """累計某條路徑的 token 用量與延遲。"""
+    stats = _stats[path]
+    stats["calls"] += 1
+    stats["latency"] += time.perf_counter() - started
+    if usage is not None:
+        stats["prompt_tokens"] += usage.prompt_token_count or 0
+        stats["cached_tokens"] += usage.cached_content_token_count or 0
+        stats["output_tokens"] += usage.candidates_token_count or 0
+
+
+async def get_cached_morning_message(
+    sleep_time: str,
+    wake_time: str,
+    sleep_hours: float,
+    quality: str,
+    todos: list[str],
+    weather: str = "",
+    events: str = "",
+    trend: str = "",
+) -> str | None:
+    """只查摘要快取（不呼叫 Gemini），沒有時回傳 None；參數同 generate_morning_message。"""
+    key = _message_key(sleep_time, wake_time, sleep_hours, quality, todos, weather, events, trend)
+    return await get_component("summary", key)
+
+
+async def generate_morning_message(
+    sleep_time: str,
+    wake_time: str,
+    sleep_hours: float,
+    quality: str,
+    todos: list[str],
+    weather: str = "",
+    events: str = "",
+    trend: str = "",
+) -> str:
+    """生成早安訊息。
+
+    trend 為近期睡眠趨勢摘要（可省略）。輸入完全相同時直接回傳快取的結果，不重新呼叫 Gemini。
+    """
+    started = time.perf_counter()
+    key = _message_key(sleep_time, wake_time, sleep_hours, quality, todos, weather, events, trend)
+    cached = await get_component("summary", key)
+    if cached is not None:
+        _record("summary_cache", None, started)
+        return cached
+
+    prompt = build_prompt(sleep_time, wake_time, sleep_hours, quality, todos, weather, events, trend)
+    cache_name = _get_context_cache()
+    try:
+        response = await call_upstream(
+            "gemini",
+            client.aio.models.generate_content,
+            model=GEMINI_MODEL,
+            contents=prompt,
+            config=_config(cache_name),
+        )
+    except Exception as e:
+        if not _should_retry_without_cache(cache_name, e):
+            raise
+        _drop_context_cache()
+        cache_name = None
+        response = await call_upstream(
+            "gemini",
+            client.aio.models.generate_content,
+            model=GEMINI_MODEL,
+            contents=prompt,
+            config=_config(None),
+        )
+    _record("context_cache" if cache_name else "system_instruction", response.usage_metadata, started)
+
+    if response.text:
+        summary = response.text.strip()
+        await set_component("summary", key, summary)
+        return summary
+    return fallback_message(sleep_time, wake_time, sleep_hours, quality)
+
+
+async def stream_morning_message(
+    sleep_time: str,
+    wake_time: str,
+    sleep_hours: float,
+    quality: str,
+    todos: list[str],
+    weather: str = "",
+    events: str = "",
+    trend: str = "",
+):
+    """以串流方式生成早安訊息，逐段 yield 文字；參數同 generate_morning_message。
+
+    有快取時一次 yield 完整結果；串流結束後完整文字會寫入摘要快取。
+    串流中途失敗時直接拋出例外，不寫入快取。
+    """
+    started = time.perf_counter()
+    key = _message_key(sleep_time, wake_time, sleep_hours, quality, todos, weather, events, trend)
+    cached = await get_component("summary", key)
+    if cached is not None:
+        _record("summary_cache", None, started)
+        yield cached
+        return
+
+    prompt = build_prompt(sleep_time, wake_time, sleep_hours, quality, todos, weather, events, trend)
+    cache_name = _get_context_cache()
+    try:
+        stream = await stream_upstream(
+            "gemini",
+            client.aio.models.generate_content_stream,
+            model=GEMINI_MODEL,
+            contents=prompt,
+            config=_config(cache_name),
+        )
+    except Exception as e:
+        if not _should_retry_without_cache(cache_name, e):
+            raise
+        _drop_context_cache()
+        cache_name = None
+        stream = await stream_upstream(
+            "gemini",
+            client.aio.models.generate_content_stream,
+            model=GEMINI_MODEL,
+            contents=prompt,
+            config=_config(None),
+        )
+
+    parts = []
+    usage = None
+    async for chunk in stream:
+        # usage_metadata 以最後一段為準
+        usage = chunk.usage_metadata or usage
+        if chunk.text:
+            parts.append(chunk.text)
+            yield chunk.text
+    _record("context_cache" if cache_name else "system_instruction", usage, started)
+
+    summary = "".join(parts).strip()
+    if summary:
+        await set_component("summary", key, summary)
+    else:
+        yield fallback_message(sleep_time, wake_time, sleep_hours, quality)
+
+
+def get_gemini_stats() -> dict:
+    """各路徑的平均延遲與 token 用量，以及 context cache 的狀態。"""
+    paths = {}
+    for path, stats in _stats.items():
+        calls = stats["calls"]
+        paths[path] = {
+            **stats,
+            "latency": round(stats["latency"], 3),
+            "avg_latency": round(stats["latency"] / calls, 3) if calls else 0.0,
+            "avg_prompt_tokens": round(stats["prompt_tokens"] / calls, 1) if calls else 0.0,
+        }
+    return {
+        "paths": paths,
+        "context_cache": {
+            "enabled": GEMINI_CONTEXT_CACHE,
+            "name": _context["name"],
+            "expires_in": round(_context["expires_at"] - time.time()) if _context["name"] else None,
+            "created": _context["created"],
+            "instruction_tokens": _context["tokens"],
+            "error": _context["error"],
+        },
+    }
+
+
 if __name__ == "__main__":
-    import asyncio
 
     async def main():
         msg = await generate_morning_message(
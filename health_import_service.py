@@ -0,0 +1,245 @@
+"""Apple Health export.xml 匯入：串流解析睡眠紀錄，逐晚分析後寫入 sleep_records。
+
+用法：python health_import_service.py export.xml（或 export.zip）
+"""
+import asyncio
+import logging
+import sys
+import time
+import zipfile
+from array import array
+from datetime import datetime
+from xml.etree import ElementTree as ET
+
+import numpy as np
+
+from sleep_batch_service import OTHER, STAGE_CODES, Segments, analyze_nights, pack_nights, split_nights, to_sleep_record
+from db_service import run_write, save_sleep_records, save_sleep_segments
+
+SLEEP_TYPE = "HKCategoryTypeIdentifierSleepAnalysis"
+
+# HealthKit 睡眠值對應到 CSV 的 Core/REM/Deep/Awake，InBed 不計入
+VALUE_MAP = {
+    "HKCategoryValueSleepAnalysisAsleepCore": "Core",
+    "HKCategoryValueSleepAnalysisAsleepREM": "REM",
+    "HKCategoryValueSleepAnalysisAsleepDeep": "Deep",
+    "HKCategoryValueSleepAnalysisAwake": "Awake",
+    # watchOS 9 以前沒有分階段，只有 Asleep
+    "HKCategoryValueSleepAnalysisAsleepUnspecified": "Core",
+    "HKCategoryValueSleepAnalysisAsleep": "Core",
+}
+
+EPOCH = datetime(1970, 1, 1)
+CHUNK_SIZE = 1024 * 1024
+PROGRESS_EVERY = 100_000  # 每掃過幾個元素回報一次進度
+SAVE_BATCH_SIZE = 1000  # 每個 transaction 寫入幾晚
+
+logger = logging.getLogger(__name__)
+
+
+def _to_epoch(value: str) -> int:
+    """將 "2024-01-01 23:10:00 +0800" 轉成當地時間（naive）的 epoch 秒。"""
+    # 只取當地的牆上時間，與 CSV 的 naive 時間一致
+    return int((datetime.fromisoformat(value[:19]) - EPOCH).total_seconds())
+
+
+class HealthSleepImporter:
+    """以 XMLPullParser 逐段餵入 export.xml，記憶體只保留精簡的睡眠片段陣列。
+
+    iPhone 與 Watch 常同時記錄同一晚，重疊的紀錄一起計算會重複計入睡眠時數，
+    所以每晚只採用一個來源（有分階段資料的優先）。
+
+    Args:
+        source: 只匯入來源名稱包含此字串的紀錄（例如 "Watch"），None 表示每晚自動選一個來源
+        progress: 進度回呼，參數為目前統計 dict
+    """
+
+    def __init__(self, source: str | None = None, progress=None):
+        self.source = source
+        self.progress = progress
+        self._parser = ET.XMLPullParser(events=("start", "end"))
+        self._root = None
+        self._depth = 0
+        self._start = array("q")
+        self._end = array("q")
+        self._stage = array("B")
+        self._source = array("H")
+        self._source_ids: dict[str, int] = {}
+        self._results = []
+        self._packed = []
+        self.stats = {
+            "bytes": 0,
+            "elements": 0,
+            "sleep_records": 0,
+            "dropped_records": 0,
+            "nights": 0,
+            "saved": 0,
+        }
+        self._started = time.perf_counter()
+
+    def feed(self, chunk: bytes):
+        """餵入一段 XML 資料並處理已完整解析的元素。"""
+        self.stats["bytes"] += len(chunk)
+        self._parser.feed(chunk)
+        self._drain()
+
+    def _drain(self):
+        for event, elem in self._parser.read_events():
+            if event == "start":
+                if self._root is None:
+                    self._root = elem
+                self._depth += 1
+                continue
+
+            self._depth -= 1
+            # 只處理 HealthData 的直接子元素，處理完就清掉以維持固定記憶體
+            if self._depth != 1:
+                continue
+            self.stats["elements"] += 1
+            if elem.tag == "Record" and elem.get("type") == SLEEP_TYPE:
+                self._add_record(elem)
+            self._root.clear()
+
+            if self.progress and self.stats["elements"] % PROGRESS_EVERY == 0:
+                self.progress(self.snapshot())
+
+    def _add_record(self, elem: ET.Element):
+        stage = VALUE_MAP.get(elem.get("value", ""))
+        if stage is None:
+            return
+        source_name = elem.get("sourceName", "")
+        if self.source and self.source not in source_name:
+            return
+        self._start.append(_to_epoch(elem.get("startDate")))
+        self._end.append(_to_epoch(elem.get("endDate")))
+        self._stage.append(STAGE_CODES.get(stage, OTHER))
+        self._source.append(self._source_ids.setdefault(source_name, len(self._source_ids)))
+        self.stats["sleep_records"] += 1
+
+    def _pick_sources(self, segments: Segments, night_ids: np.ndarray, source: np.ndarray) -> tuple[Segments, np.ndarray]:
+        """每晚只保留一個來源的片段：有分階段（Deep/REM）的來源優先，其次比睡眠時數。
+
+        iPhone 等只有 AsleepUnspecified 的來源會被當成 Core，時數常比 Watch 長，
+        只比時數會選到沒有階段資料的來源。
+        """
+        sources = len(self._source_ids)
+        if sources <= 1 or len(night_ids) == 0:
+            return segments, night_ids
+
+        nights = int(night_ids[-1]) + 1
+        size = nights * sources
+        group = night_ids * sources + source
+        asleep = np.where(segments.stage < OTHER, segments.duration_hr, 0.0)
+        hours = np.bincount(group, weights=asleep, minlength=size).reshape(nights, sources)
+        staged = np.isin(segments.stage, (STAGE_CODES["Deep"], STAGE_CODES["REM"]))
+        has_stages = np.bincount(group, weights=staged, minlength=size).reshape(nights, sources) > 0
+        counts = np.bincount(group, minlength=size).reshape(nights, sources)
+
+        # 先比是否有階段資料，再比時數（一晚不會超過 48 小時）；
+        # 當晚沒有紀錄的來源不能被選到（每晚至少留下一個片段，晚次編號保持連續）
+        score = np.where(counts > 0, has_stages * 48.0 + hours, -1.0)
+        keep = source == score.argmax(axis=1)[night_ids]
+
+        self.stats["dropped_records"] = int(len(keep) - keep.sum())
+        return Segments(*(column[keep] for column in segments)), night_ids[keep]
+
+    def snapshot(self) -> dict:
+        """目前進度（含已耗時）。"""
+        return {**self.stats, "elapsed": round(time.perf_counter() - self._started, 1)}
+
+    def close(self) -> dict:
+        """結束解析並逐晚分析（尚未寫入，之後呼叫 save）。
+
+        Returns:
+            目前統計
+        """
+        self._parser.close()
+        self._drain()
+
+        start = np.frombuffer(self._start, dtype=np.int64)
+        end = np.frombuffer(self._end, dtype=np.int64)
+        stage = np.frombuffer(self._stage, dtype=np.uint8)
+        source = np.frombuffer(self._source, dtype=np.uint16)
+        order = np.argsort(start, kind="stable")
+        segments = Segments(
+            start=start[order],
+            end=end[order],
+            duration_hr=(end[order] - start[order]) / 3600,
+            stage=stage[order],
+        )
+
+        night_ids = split_nights(segments)
+        segments, night_ids = self._pick_sources(segments, night_ids, source[order])
+        self._results = analyze_nights(segments, night_ids)
+        self._packed = pack_nights(segments, night_ids)
+        self.stats["nights"] = len(self._results)
+        return self.snapshot()
+
+    async def save(self) -> dict:
+        """經由 DB 寫入執行緒分批寫入 sleep_records 與原始片段（每批 SAVE_BATCH_SIZE 晚）。
+
+        Returns:
+            匯入統計
+        """
+        for i in range(0, len(self._results), SAVE_BATCH_SIZE):
+            batch = self._results[i:i + SAVE_BATCH_SIZE]
+            self.stats["saved"] += await run_write(save_sleep_records, [to_sleep_record(r) for r in batch])
+            await run_write(save_sleep_segments, self._packed[i:i + SAVE_BATCH_SIZE])
+            if self.progress:
+                self.progress(self.snapshot())
+        return self.snapshot()
+
+
+def read_export_file(path: str, source: str | None = None, progress=None) -> HealthSleepImporter:
+    """讀取並分析 export.xml 或 iPhone 匯出的 export.zip（尚未寫入）。"""
+    importer = HealthSleepImporter(source=source, progress=progress)
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as zf:
+            name = next(n for n in zf.namelist() if n.endswith("/export.xml") or n == "export.xml")
+            with zf.open(name) as f:
+                while chunk := f.read(CHUNK_SIZE):
+                    importer.feed(chunk)
+    else:
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                importer.feed(chunk)
+    importer.close()
+    return importer
+
+
+async def import_export_file(path: str, source: str | None = None, progress=None, save: bool = True) -> dict:
+    """匯入 export.xml 或 export.zip；解析在背景執行緒，寫入經由 DB 寫入執行緒。"""
+    importer = await asyncio.to_thread(read_export_file, path, source, progress)
+    return await importer.save() if save else importer.snapshot()
+
+
+def format_progress(stats: dict) -> str:
+    """進度的一行文字摘要。"""
+    return (
+        f"[{stats['elapsed']}s] 讀取 {stats['bytes'] / 1024 / 1024:.0f} MB，"
+        f"{stats['elements']} 個元素，睡眠紀錄 {stats['sleep_records']} 筆，"
+        f"已寫入 {stats['saved']}/{stats['nights']} 晚"
+    )
+
+
+def print_progress(stats: dict):
+    """CLI 用：進度印到終端機。"""
+    print(format_progress(stats))
+
+
+def log_progress(stats: dict):
+    """API 用：進度寫入 log，不佔用伺服器的 stdout。"""
+    logger.info("Health 匯入進度 %s", format_progress(stats))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("用法：python health_import_service.py export.xml [來源名稱]")
+        sys.exit(1)
+
+    result = asyncio.run(import_export_file(
+        sys.argv[1],
+        source=sys.argv[2] if len(sys.argv) > 2 else None,
+        progress=print_progress,
+    ))
+    print_progress(result)
@@ -0,0 +1,60 @@
+import os
+from importlib.util import find_spec
+
+from dotenv import load_dotenv
+import httpx
+
+load_dotenv()
+
+# 連線池與逾時設定
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+# HTTP/2 需要安裝 h2（pip install "httpx[http2]"），未安裝時自動退回 HTTP/1.1
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() in ("1", "true", "yes")
+# CWA 憑證鏈在部分環境無法驗證，沿用原本的 verify=False
+HTTP_VERIFY = os.getenv("HTTP_VERIFY", "false").lower() in ("1", "true", "yes")
+
+_client: httpx.AsyncClient | None = None
+
+
+def _create_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        verify=HTTP_VERIFY,
+        http2=HTTP2_ENABLED and find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    )
+
+
+async def init_http_client() -> httpx.AsyncClient:
+    """建立共用的 HTTP client（由 FastAPI lifespan 呼叫）。"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _create_client()
+    return _client
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """取得共用的 HTTP client，保持連線以重複使用 TCP/TLS 連線。
+
+    在 lifespan 之外（例如直接執行模組）呼叫時會自動建立。
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _create_client()
+    return _client
+
+
+async def close_http_client():
+    """關閉共用的 HTTP client，釋放連線池。"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
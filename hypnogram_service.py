@@ -0,0 +1,115 @@
+"""睡眠階段時間軸（hypnogram）：將一晚的原始片段重新取樣成固定數量的區間。"""
+import hashlib
+import os
+from collections import OrderedDict
+from datetime import date
+
+import numpy as np
+from dotenv import load_dotenv
+
+from sleep_batch_service import OTHER, STAGES, unpack_nights
+from db_service import get_recent_sleep_segments, get_sleep_segments, run_read
+
+load_dotenv()
+
+HYPNOGRAM_BINS = int(os.getenv("HYPNOGRAM_BINS", "96"))
+HYPNOGRAM_MAX_BINS = 480
+HYPNOGRAM_CACHE_SIZE = int(os.getenv("HYPNOGRAM_CACHE_SIZE", "256"))
+
+# stages 陣列中的代碼：STAGES 的索引、OTHER 代表只有 InBed，-1 代表沒有紀錄
+LABELS = (*STAGES, "InBed")
+NO_DATA = -1
+
+# 過去的夜晚很少變動，以 (日期, 區間數) 做 LRU 快取；同時記下片段內容的雜湊，
+# 片段被重新匯入（其他 worker 或 CLI 寫入）時內容不同就重算
+_cache: OrderedDict[tuple[str, int], tuple[bytes, dict]] = OrderedDict()
+_stats = {"hits": 0, "misses": 0}
+
+
+def bin_stages(start: np.ndarray, end: np.ndarray, stage: np.ndarray, bins: int) -> tuple[np.ndarray, int, int]:
+    """將片段依時間重疊量分配到 bins 個等寬區間，每個區間取佔比最高的階段。
+
+    Returns:
+        (每個區間的階段代碼, 起始 epoch 秒, 結束 epoch 秒)
+    """
+    t0, t1 = int(start.min()), int(end.max())
+    edges = np.linspace(t0, t1, bins + 1)
+
+    # 片段 × 區間的重疊秒數，再乘上階段的 one-hot 矩陣得到每個區間各階段的秒數
+    overlap = np.minimum(end[:, None], edges[None, 1:]) - np.maximum(start[:, None], edges[None, :-1])
+    np.clip(overlap, 0, None, out=overlap)
+    per_stage = overlap.T @ np.eye(OTHER + 1)[stage]
+
+    # InBed 只在沒有任何睡眠階段時才顯示
+    asleep = per_stage[:, :OTHER]
+    codes = np.where(asleep.any(axis=1), asleep.argmax(axis=1), np.where(per_stage[:, OTHER] > 0, OTHER, NO_DATA))
+    return codes, t0, t1
+
+
+def _build(row: dict, bins: int) -> dict:
+    segments, _ = unpack_nights([row])
+    codes, t0, t1 = bin_stages(segments.start, segments.end, segments.stage, bins)
+    return {
+        "date": row["date"],
+        "start": np.datetime64(t0, "s").item().isoformat(),
+        "end": np.datetime64(t1, "s").item().isoformat(),
+        "bin_minutes": round((t1 - t0) / bins / 60, 2),
+        "stages": codes.tolist(),
+    }
+
+
+def get_hypnogram(row: dict, bins: int = HYPNOGRAM_BINS) -> dict:
+    """由 sleep_segments 的一列產生時間軸；今天以前的夜晚會快取。"""
+    key = (row["date"], bins)
+    version = hashlib.blake2b(row["data"], digest_size=16).digest()
+    cached = _cache.get(key)
+    if cached and cached[0] == version:
+        _stats["hits"] += 1
+        _cache.move_to_end(key)
+        return cached[1]
+
+    _stats["misses"] += 1
+    result = _build(row, bins)
+    if row["date"] < date.today().isoformat():
+        _cache[key] = (version, result)
+        _cache.move_to_end(key)
+        while len(_cache) > HYPNOGRAM_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+
+def invalidate_hypnograms(dates=None):
+    """清除指定日期（None 為全部）的時間軸快取；保存新的片段後呼叫。"""
+    if dates is None:
+        _cache.clear()
+        return
+    dates = set(dates)
+    for key in [key for key in _cache if key[0] in dates]:
+        del _cache[key]
+
+
+def _clamp_bins(bins: int) -> int:
+    return max(1, min(bins, HYPNOGRAM_MAX_BINS))
+
+
+async def get_recent_hypnograms(nights: int = 7, bins: int = HYPNOGRAM_BINS) -> dict:
+    """取得最近 N 晚的時間軸（由舊到新）。"""
+    bins = _clamp_bins(bins)
+    rows = await run_read(get_recent_sleep_segments, nights)
+    return {
+        "labels": LABELS,
+        "nights": [get_hypnogram(row, bins) for row in reversed(rows)],
+    }
+
+
+async def get_hypnogram_on(sleep_date: date, bins: int = HYPNOGRAM_BINS) -> dict | None:
+    """取得指定日期的時間軸，沒有保存片段時回傳 None。"""
+    row = await run_read(get_sleep_segments, sleep_date)
+    if row is None:
+        return None
+    return {"labels": LABELS, **get_hypnogram(row, _clamp_bins(bins))}
+
+
+def get_hypnogram_cache_stats() -> dict:
+    """時間軸快取的命中統計。"""
+    return {**_stats, "size": len(_cache)}
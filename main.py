@@ -1,15 +1,83 @@
+import asyncio
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime, date
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
-from todoist_service import get_tasks
-from sleep_service import analyze_sleep
-from gemini_service import generate_morning_message
-from weather_service import get_weather
-from calendar_service import get_today_events, format_events_for_prompt
-from db_service import save_sleep_record, get_recent_sleep_records, get_morning_cache, save_morning_cache
-
-app = FastAPI(title="Personal AI Assistant")
+from todoist_service import get_mirrored_tasks
+from sleep_service import (
+    analyze_sleep,
+    analyze_sleep_cached,
+    fingerprint_csv,
+    format_sleep_trend,
+    get_sleep_upload_stats,
+    SleepAnalysis,
+)
+from sleep_batch_service import analyze_and_pack, pack_sleep_csv, rescore_all_nights, to_sleep_record
+from hypnogram_service import (
+    HYPNOGRAM_BINS,
+    get_hypnogram_cache_stats,
+    get_hypnogram_on,
+    get_recent_hypnograms,
+    invalidate_hypnograms,
+)
+from health_import_service import HealthSleepImporter, log_progress
+from gemini_service import (
+    fallback_message,
+    generate_morning_message,
+    get_cached_morning_message,
+    get_gemini_stats,
+    start_context_cache,
+    stream_morning_message,
+)
+from calendar_service import format_events_for_prompt, get_calendar_sync_stats
+from briefing_service import MORNING_BUDGET, gather_morning_data, iter_morning_data, sdk_executor, stale_sections
+from morning_cache_service import (
+    get_morning_response,
+    invalidate_morning_cache,
+    response_key,
+    save_morning_response,
+)
+from resilience_service import get_resilience_stats
+from singleflight_service import get_single_flight_stats, single_flight
+from component_cache_service import COMPONENT_TTLS, get_component_cache_stats, invalidate_component
+from http_service import init_http_client, close_http_client
+from weather_service import get_weather_many, get_weather_cache_stats
+from db_service import (
+    save_sleep_record_async,
+    get_recent_sleep_records_async,
+    get_sleep_stats_async,
+    save_sleep_records,
+    save_sleep_segments,
+    save_sleep_upload,
+    run_write,
+    close_connection,
+    shutdown_db_executor,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """應用程式生命週期：建立與釋放共用資源。"""
+    await init_http_client()
+    start_context_cache()
+    yield
+    # 等背景工作（睡眠紀錄寫入、逾時的 Gemini 結果）收尾後再關閉連線
+    if _background_tasks:
+        await asyncio.wait(_background_tasks, timeout=MORNING_BUDGET)
+    await close_http_client()
+    sdk_executor.shutdown(wait=False, cancel_futures=True)
+    close_connection()
+    shutdown_db_executor()
+
+
+app = FastAPI(title="Personal AI Assistant", lifespan=lifespan)
+logger = logging.getLogger(__name__)
 
 
 def format_display(
@@ -65,6 +133,7 @@ class MorningResponse(BaseModel):
     events: list[dict]  # 今日行程
     display: str  # 給捷徑顯示用的完整文字
     cached: bool = False  # 是否來自快取
+    stale: list[str] = []  # 外部服務失敗、改用先前資料或 fallback 的區塊
 
 
 @app.get("/health")
@@ -78,69 +147,161 @@ async def morning(request: MorningRequest):
     """早安流程。"""
     today = date.today()
 
-    cached = get_morning_cache(today)
-    if cached:
-        return MorningResponse(
-            summary=cached["summary"],
-            todos=cached["todos"],
-            weather=cached["weather"],
-            events=cached["events"],
-            display=cached["display"],
-            cached=True,
+    # 快取命中時直接回傳已序列化的 JSON，不再經過 Pydantic
+    cache_key = response_key(today, request.location, fingerprint_csv(request.sleep_csv))
+    cached = await get_morning_response(cache_key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+
+    # 相同輸入的並發請求只跑一次流程，其餘等待同一個結果
+    payload = await single_flight(
+        cache_key,
+        lambda: _run_morning(request, today, cache_key),
+        wait_for_peer=lambda: get_morning_response(cache_key),
+    )
+    return Response(content=payload, media_type="application/json")
+
+
+async def _save_sleep(sleep_csv: str, sleep: SleepAnalysis, upload: dict):
+    """寫入睡眠紀錄、上傳紀錄與原始片段。"""
+    # 同一份 CSV 已寫入過紀錄就不再重寫
+    if not upload["record_saved"]:
+        await save_sleep_record_async(
+            sleep_date=sleep.sleep_end.date(),
+            sleep_start=sleep.sleep_start,
+            sleep_end=sleep.sleep_end,
+            total_hours=sleep.total_hours,
+            actual_sleep_hours=sleep.actual_sleep_hours,
+            deep_hours=sleep.deep_hours,
+            rem_hours=sleep.rem_hours,
+            core_hours=sleep.core_hours,
+            awake_hours=sleep.awake_hours,
+            awake_count=sleep.awake_count,
+            sleep_efficiency=sleep.sleep_efficiency,
+            quality_score=sleep.quality_score,
+            note=sleep.note,
         )
+        await run_write(save_sleep_upload, upload["content_hash"], sleep.model_dump_json(), record_saved=True)
+        # 保存原始片段，日後調整評分規則時可重新計算；只是附帶資料，失敗不影響回應
+        try:
+            segments = await run_in_threadpool(pack_sleep_csv, sleep_csv, single_night=True)
+            await run_write(save_sleep_segments, segments)
+            invalidate_hypnograms(row[0] for row in segments)
+        except Exception:
+            logger.exception("睡眠原始片段保存失敗（%s）", upload["content_hash"])
 
-    sleep = analyze_sleep(request.sleep_csv)
 
-    weather = await get_weather(request.location)
-    weather_summary = weather.get("summary", "天氣資料取得失敗")
+# 回應之後才完成的背景工作：睡眠紀錄寫入、超過時間預算的 Gemini 呼叫（保留參照避免被回收）
+_background_tasks: set[asyncio.Task] = set()
 
-    events = get_today_events()
-    events_text = format_events_for_prompt(events)
 
-    tasks = get_tasks()
-    todo_list = [t.content for t in tasks[:5]]
+def _run_in_background(coro):
+    """在背景執行，不阻塞回應；失敗時記錄到 log。"""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_done)
 
-    sleep_time = sleep.sleep_start.strftime("%H:%M")
-    wake_time = sleep.sleep_end.strftime("%H:%M")
 
-    save_sleep_record(
-        sleep_date=sleep.sleep_end.date(),
-        sleep_start=sleep.sleep_start,
-        sleep_end=sleep.sleep_end,
-        total_hours=sleep.total_hours,
-        actual_sleep_hours=sleep.actual_sleep_hours,
-        deep_hours=sleep.deep_hours,
-        rem_hours=sleep.rem_hours,
-        core_hours=sleep.core_hours,
-        awake_hours=sleep.awake_hours,
-        awake_count=sleep.awake_count,
-        sleep_efficiency=sleep.sleep_efficiency,
-        quality_score=sleep.quality_score,
-        note=sleep.note,
+def _background_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("背景工作失敗", exc_info=task.exception())
+
+
+async def _save_late_summary(
+    generation: asyncio.Task,
+    cache_key: str,
+    today: date,
+    weather: str,
+    events: list[dict],
+    todos: list[str],
+    stale: list[str],
+):
+    """超過預算的 Gemini 結果完成後，以完整摘要更新回應快取。"""
+    try:
+        summary = await generation
+    except Exception:
+        return
+    await save_morning_response(
+        cache_key,
+        cache_date=today,
+        summary=summary,
+        weather=weather,
+        events=events,
+        todos=todos,
+        display=format_display(summary, weather, events, todos),
+        stale=stale,
     )
 
+
+async def _sleep_stats_within(deadline: float) -> dict:
+    """在剩餘預算內讀取睡眠統計，來不及時回傳沒有任何區間的統計（摘要省略趨勢）。"""
     try:
-        summary = await generate_morning_message(
-            sleep_time=sleep_time,
-            wake_time=wake_time,
-            sleep_hours=sleep.actual_sleep_hours,
-            quality=sleep.quality_score,
-            todos=todo_list,
-            weather=weather_summary,
-            events=events_text,
-        )
-    except Exception as e:
-        summary = f"生成早安訊息時發生錯誤：{str(e)}"
+        return await asyncio.wait_for(get_sleep_stats_async(), max(deadline - time.monotonic(), 0))
+    except asyncio.TimeoutError:
+        return {"windows": {}}
+
+
+async def _run_morning(request: MorningRequest, today: date, cache_key: str) -> str:
+    """執行完整的早安流程並寫入快取，回傳序列化後的 MorningResponse。
+
+    整個流程以 MORNING_BUDGET 為上限：來源逾時改用最後已知的資料，
+    Gemini 來不及時先回傳本地摘要，Gemini 的結果在背景完成後再更新快取。
+    睡眠紀錄在背景寫入；睡眠趨勢讀取也受預算限制，來不及時省略。
+    """
+    deadline = time.monotonic() + MORNING_BUDGET
+    sleep, upload = await analyze_sleep_cached(request.sleep_csv)
+
+    data = await gather_morning_data(request.location, budget=deadline - time.monotonic())
+    weather_summary = data["weather"].get("summary", "天氣資料取得失敗")
+    events = data["events"]
+    events_text = format_events_for_prompt(events)
+    todo_list = data["todos"]
+
+    sleep_time = sleep.sleep_start.strftime("%H:%M")
+    wake_time = sleep.sleep_end.strftime("%H:%M")
+
+    _run_in_background(_save_sleep(request.sleep_csv, sleep, upload))
+
+    message_inputs = {
+        "sleep_time": sleep_time,
+        "wake_time": wake_time,
+        "sleep_hours": sleep.actual_sleep_hours,
+        "quality": sleep.quality_score,
+        "todos": todo_list,
+        "weather": weather_summary,
+        "events": events_text,
+        "trend": format_sleep_trend(await _sleep_stats_within(deadline)),
+    }
+    stale = data["stale"]
+    # 摘要快取命中時不受剩餘預算影響（預算用完時 wait_for 一律逾時）
+    summary = await get_cached_morning_message(**message_inputs)
+    if summary is None:
+        generation = asyncio.ensure_future(generate_morning_message(**message_inputs))
+        try:
+            summary = await asyncio.wait_for(asyncio.shield(generation), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            summary = fallback_message(sleep_time, wake_time, sleep.actual_sleep_hours, sleep.quality_score)
+            _run_in_background(
+                _save_late_summary(generation, cache_key, today, weather_summary, events, todo_list, stale)
+            )
+            stale = [*stale, "summary"]
+        except Exception:
+            # Gemini 失敗（含斷路器開啟中）時使用本地摘要
+            summary = fallback_message(sleep_time, wake_time, sleep.actual_sleep_hours, sleep.quality_score)
+            stale = [*stale, "summary"]
 
     display = format_display(summary, weather_summary, events, todo_list)
 
-    save_morning_cache(
+    await save_morning_response(
+        cache_key,
         cache_date=today,
         summary=summary,
         weather=weather_summary,
         events=events,
         todos=todo_list,
         display=display,
+        stale=stale,
     )
 
     return MorningResponse(
@@ -150,9 +311,117 @@ async def morning(request: MorningRequest):
         events=events,
         display=display,
         cached=False,
+        stale=stale,
+    ).model_dump_json()
+
+
+def _sse(event: str, data) -> str:
+    """組成一則 Server-Sent Event。"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _stream_morning(request: MorningRequest, today: date, cache_key: str):
+    """依完成順序送出各區塊，再逐段送出 AI 摘要，最後送出完整回應並寫入快取。
+
+    事件：sleep、weather、events、todos（先完成的先送）、summary（多次，每次一段文字）、
+    done（完整的 MorningResponse）；快取命中時只送 done。
+    摘要串流中途失敗時，done 的 summary 會換成本地摘要，stale 包含 "summary"。
+    """
+    cached = await get_morning_response(cache_key)
+    if cached is not None:
+        yield f"event: done\ndata: {cached}\n\n"
+        return
+
+    sleep, upload = await analyze_sleep_cached(request.sleep_csv)
+    sleep_time = sleep.sleep_start.strftime("%H:%M")
+    wake_time = sleep.sleep_end.strftime("%H:%M")
+    yield _sse("sleep", {
+        "sleep_time": sleep_time,
+        "wake_time": wake_time,
+        "sleep_hours": sleep.actual_sleep_hours,
+        "quality": sleep.quality_score,
+    })
+
+    data = {}
+    errors = {}
+    async for key, value in iter_morning_data(request.location, errors, {}):
+        if key == "weather":
+            value = value.get("summary", "天氣資料取得失敗")
+        data[key] = value
+        yield _sse(key, value)
+
+    _run_in_background(_save_sleep(request.sleep_csv, sleep, upload))
+
+    parts = []
+    try:
+        async for text in stream_morning_message(
+            sleep_time=sleep_time,
+            wake_time=wake_time,
+            sleep_hours=sleep.actual_sleep_hours,
+            quality=sleep.quality_score,
+            todos=data["todos"],
+            weather=data["weather"],
+            events=format_events_for_prompt(data["events"]),
+            trend=format_sleep_trend(await get_sleep_stats_async()),
+        ):
+            parts.append(text)
+            yield _sse("summary", text)
+        summary = "".join(parts).strip()
+        stale = stale_sections(errors)
+    except Exception:
+        # Gemini 失敗（含串流中途中斷）時改用本地摘要；已送出的片段不完整，以 done 的 summary 為準
+        stale = [*stale_sections(errors), "summary"]
+        summary = fallback_message(sleep_time, wake_time, sleep.actual_sleep_hours, sleep.quality_score)
+        if not parts:
+            yield _sse("summary", summary)
+
+    display = format_display(summary, data["weather"], data["events"], data["todos"])
+    await save_morning_response(
+        cache_key,
+        cache_date=today,
+        summary=summary,
+        weather=data["weather"],
+        events=data["events"],
+        todos=data["todos"],
+        display=display,
+        stale=stale,
+    )
+    response = MorningResponse(
+        summary=summary,
+        todos=data["todos"],
+        weather=data["weather"],
+        events=data["events"],
+        display=display,
+        stale=stale,
+    )
+    yield f"event: done\ndata: {response.model_dump_json()}\n\n"
+
+
+@app.post("/morning/stream")
+async def morning_stream(request: MorningRequest):
+    """早安流程的串流版本（text/event-stream），各區塊就緒就先送出。"""
+    cache_key = response_key(date.today(), request.location, fingerprint_csv(request.sleep_csv))
+    return StreamingResponse(
+        _stream_morning(request, date.today(), cache_key),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
+@app.delete("/morning/cache")
+async def clear_morning_cache(cache_date: date | None = None):
+    """清除早安快取（不指定日期則全部清除），所有 worker 都會失效。"""
+    return await invalidate_morning_cache(cache_date)
+
+
+@app.delete("/cache/{component}")
+async def clear_component_cache(component: str):
+    """清除單一元件的快取（events、todos、summary、response）。"""
+    if component not in COMPONENT_TTLS:
+        raise HTTPException(status_code=404, detail=f"沒有 {component} 這個快取")
+    return await invalidate_component(component)
+
+
 @app.get("/test/morning")
 async def test_morning():
     """測試早安流程（使用假睡眠數據）。"""
@@ -166,16 +435,12 @@ async def test_morning():
 
     sleep = analyze_sleep(sleep_csv)
 
-    # 取得天氣
-    weather = await get_weather("新竹市")
-    weather_summary = weather.get("summary", "天氣資料取得失敗")
-
-    # 取得今日行程
-    events = get_today_events()
+    # 同時取得天氣、行程、待辦
+    data = await gather_morning_data("新竹市")
+    weather_summary = data["weather"].get("summary", "天氣資料取得失敗")
+    events = data["events"]
     events_text = format_events_for_prompt(events)
-
-    tasks = get_tasks()
-    todo_list = [t.content for t in tasks[:5]]
+    todo_list = data["todos"]
 
     sleep_time = sleep.sleep_start.strftime("%H:%M")
     wake_time = sleep.sleep_end.strftime("%H:%M")
@@ -194,12 +459,12 @@ async def test_morning():
 
 
 @app.get("/test/tasks")
-async def test_tasks():
-    """測試取得 Todoist 待辦事項。"""
-    tasks = get_tasks()
+async def test_tasks(refresh: bool = False):
+    """測試取得 Todoist 待辦事項（從本地鏡像讀取，refresh=true 強制同步）。"""
+    tasks = await get_mirrored_tasks(refresh=refresh)
     return {
         "count": len(tasks),
-        "tasks": [{"id": t.id, "content": t.content} for t in tasks],
+        "tasks": [{"id": t["id"], "content": t["content"]} for t in tasks],
     }
 
 
@@ -209,11 +474,103 @@ class SleepAnalysisRequest(BaseModel):
 
 @app.post("/test/sleep_analyze")
 async def analyze_sleep_endpoint(request: SleepAnalysisRequest):
-    """分析睡眠數據（接收 CSV 格式）。"""
-    return analyze_sleep(request.csv_data)
+    """分析睡眠數據（接收 CSV 格式），重複的 CSV 直接回傳先前的結果。"""
+    sleep, upload = await analyze_sleep_cached(request.csv_data)
+    if not upload["hit"]:
+        await run_write(save_sleep_upload, upload["content_hash"], sleep.model_dump_json(), record_saved=False)
+    return sleep
+
+
+class SleepBatchRequest(BaseModel):
+    csv_data: str  # 包含多晚的 Apple Watch 睡眠 CSV
+    save: bool = True  # 是否寫入 sleep_records
+
+
+class SleepBatchResponse(BaseModel):
+    nights: int
+    saved: int
+    results: list[SleepAnalysis]
+
+
+@app.post("/sleep/batch")
+async def analyze_sleep_batch_endpoint(request: SleepBatchRequest):
+    """分析多晚的睡眠數據，每晚一筆結果，並可一次批次寫入（含原始片段）。"""
+    results, segments = await run_in_threadpool(analyze_and_pack, request.csv_data)
+    saved = 0
+    if request.save and results:
+        saved = await run_write(save_sleep_records, [to_sleep_record(r) for r in results])
+        await run_write(save_sleep_segments, segments)
+        invalidate_hypnograms(row[0] for row in segments)
+    return SleepBatchResponse(nights=len(results), saved=saved, results=results)
+
+
+@app.post("/sleep/rescore")
+async def rescore_sleep_records():
+    """以目前的評分規則，從已保存的原始片段重新計算所有夜晚的睡眠紀錄。"""
+    return await rescore_all_nights()
+
+
+@app.post("/sleep/import")
+async def import_health_export(request: Request, source: str | None = None):
+    """串流上傳 Apple Health export.xml，邊收邊解析並寫入睡眠紀錄。
+
+    Body 直接放 export.xml 原始內容；source 可只匯入特定來源（例如 Watch），
+    不指定時每晚自動選一個來源。進度寫入 log，回應為最後的匯入統計。
+    """
+    importer = HealthSleepImporter(source=source, progress=log_progress)
+    async for chunk in request.stream():
+        if chunk:
+            await run_in_threadpool(importer.feed, chunk)
+    await run_in_threadpool(importer.close)
+    result = await importer.save()
+    invalidate_hypnograms()
+    return result
 
 
 @app.get("/sleep/history")
 async def get_sleep_history(days: int = 7):
     """取得最近 N 天的睡眠紀錄。"""
-    return get_recent_sleep_records(days)
+    return await get_recent_sleep_records_async(days)
+
+
+@app.get("/weather")
+async def get_weather_for_locations(locations: str = "新竹市"):
+    """取得多個地點的天氣（以逗號分隔，例如 新竹市,臺北市）。"""
+    names = [name.strip() for name in locations.split(",") if name.strip()]
+    return await get_weather_many(names)
+
+
+@app.get("/sleep/stats")
+async def get_sleep_stats_endpoint():
+    """取得 7/30/90 天的平均睡眠、睡眠負債與晚睡比例。"""
+    return await get_sleep_stats_async()
+
+
+@app.get("/sleep/hypnogram")
+async def get_hypnograms(days: int = 7, bins: int = HYPNOGRAM_BINS):
+    """取得最近 N 晚的睡眠階段時間軸，每晚固定 bins 個區間。"""
+    return await get_recent_hypnograms(days, bins)
+
+
+@app.get("/sleep/hypnogram/{sleep_date}")
+async def get_hypnogram_endpoint(sleep_date: date, bins: int = HYPNOGRAM_BINS):
+    """取得指定日期（起床那天）的睡眠階段時間軸。"""
+    result = await get_hypnogram_on(sleep_date, bins)
+    if result is None:
+        raise HTTPException(status_code=404, detail="這天沒有保存睡眠片段")
+    return result
+
+
+@app.get("/stats")
+async def get_stats():
+    """取得快取命中等統計資訊。"""
+    return {
+        "weather_cache": get_weather_cache_stats(),
+        "calendar_sync": get_calendar_sync_stats(),
+        "sleep_uploads": await get_sleep_upload_stats(),
+        "hypnogram_cache": get_hypnogram_cache_stats(),
+        "briefing_cache": get_component_cache_stats(),
+        "single_flight": get_single_flight_stats(),
+        "gemini": get_gemini_stats(),
+        "upstreams": get_resilience_stats(),
+    }
@@ -0,0 +1,54 @@
+"""早安完整回應的快取：以 (日期, 地點, 睡眠 CSV 雜湊) 為 key，存放已序列化的 MorningResponse JSON。
+
+建立在 component_cache_service 的 "response" 元件上（記憶體 LRU + SQLite、跨 worker 失效），
+TTL 很短；過期後重新組合時，各區塊與 AI 摘要仍會各自命中自己的快取。
+morning_cache 資料表則保留每天最後一次的 briefing 作為紀錄。
+"""
+import json
+from datetime import date
+
+from component_cache_service import get_component, invalidate_component, set_component
+from db_service import run_write, save_morning_cache
+
+COMPONENT = "response"
+
+
+def response_key(cache_date: date, location: str, content_hash: str) -> str:
+    """組合回應快取的 key；日期放最前面，方便依日期失效。"""
+    return f"{cache_date.isoformat()}|{location}|{content_hash}"
+
+
+def _to_json(body: dict) -> str:
+    """序列化成 MorningResponse 的 JSON（cached=True）。"""
+    return json.dumps({**body, "cached": True}, ensure_ascii=False, separators=(",", ":"))
+
+
+async def get_morning_response(key: str) -> str | None:
+    """取得已序列化的早安回應，沒有快取時回傳 None。"""
+    return await get_component(COMPONENT, key)
+
+
+async def save_morning_response(
+    key: str,
+    cache_date: date,
+    summary: str,
+    weather: str,
+    events: list[dict],
+    todos: list[str],
+    display: str,
+    stale: list[str] | None = None,
+):
+    """寫入回應快取，並更新當天的 morning_cache 紀錄。
+
+    Args:
+        stale: 使用了先前資料或 fallback 的區塊
+    """
+    body = {"summary": summary, "todos": todos, "weather": weather, "events": events, "display": display}
+    await set_component(COMPONENT, key, _to_json({**body, "stale": stale or []}))
+    await run_write(save_morning_cache, cache_date=cache_date, **body)
+
+
+async def invalidate_morning_cache(cache_date: date | None = None) -> dict:
+    """清除回應快取（None 為全部），所有 worker 都會失效。"""
+    prefix = cache_date.isoformat() if cache_date else None
+    return await invalidate_component(COMPONENT, prefix)
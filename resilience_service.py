@@ -0,0 +1,242 @@
+"""外部服務（CWA、Google Calendar、Todoist、Gemini）共用的韌性機制。
+
+- 斷路器：連續失敗達門檻後一段時間內直接拒絕呼叫（CircuitOpenError），不再等逾時
+- 重試：只重試暫時性錯誤（連線錯誤、逾時、429、5xx），指數退避加 full jitter 且有上限
+- 最後已知的正確資料：成功時寫入記憶體與 SQLite last_known_good，失敗時可取回並標記為過期
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+
+import httplib2
+import httpx
+from dotenv import load_dotenv
+from google.auth.exceptions import TransportError as GoogleAuthTransportError
+
+from db_service import get_last_known_good, run_read, run_write, save_last_known_good
+
+load_dotenv()
+
+RESILIENCE_RETRIES = int(os.getenv("RESILIENCE_RETRIES", "2"))
+RESILIENCE_BACKOFF_BASE = float(os.getenv("RESILIENCE_BACKOFF_BASE", "0.2"))
+RESILIENCE_BACKOFF_CAP = float(os.getenv("RESILIENCE_BACKOFF_CAP", "2"))
+# 連續幾次失敗就斷路、斷路多久（秒）後放一個試探請求
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
+# httpx（CWA、Todoist、Gemini）與 httplib2 / google-auth（Google Calendar）的連線層錯誤
+RETRYABLE_EXCEPTIONS = (
+    httpx.TransportError,
+    httplib2.HttpLib2Error,
+    GoogleAuthTransportError,
+    asyncio.TimeoutError,
+    TimeoutError,
+    ConnectionError,
+)
+
+
+class CircuitOpenError(RuntimeError):
+    """斷路器開啟中，呼叫未送出。"""
+
+
+class StaleDataError(Exception):
+    """外部服務失敗，但有先前的資料可用；data 為可用的資料，reason 為失敗原因。"""
+
+    def __init__(self, data, reason: str):
+        super().__init__(reason)
+        self.data = data
+        self.reason = reason
+
+
+class CircuitBreaker:
+    """單一外部服務的斷路器（closed → open → half_open → closed），thread-safe。"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.stats = {"calls": 0, "failures": 0, "rejected": 0, "retries": 0, "opened": 0}
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """是否允許送出請求；open 超過 BREAKER_RESET_TIMEOUT 後只放行一個試探請求。"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= BREAKER_RESET_TIMEOUT:
+                self.state = "half_open"
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.stats["calls"] += 1
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["failures"] += 1
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= BREAKER_FAILURE_THRESHOLD:
+                if self.state != "open":
+                    self.stats["opened"] += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def record_abandoned(self):
+        """請求被取消（逾時、用戶端斷線）沒有結果；試探請求被取消時回到 open，避免卡在 half_open。"""
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.failures, **self.stats}
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+# 最後已知的正確資料：(upstream, key) -> data
+_last_good: dict[tuple[str, str], object] = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """取得（必要時建立）指定服務的斷路器。"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def _status_of(exc: Exception) -> int | None:
+    """從各 SDK 的例外取出 HTTP 狀態碼（httpx、googleapiclient、google-genai）。"""
+    response = getattr(exc, "response", None) or getattr(exc, "resp", None)
+    for source in (exc, response):
+        for attr in ("status_code", "status", "code"):
+            value = getattr(source, attr, None)
+            if isinstance(value, int):
+                return value
+    return None
+
+
+def is_retryable(exc: Exception) -> bool:
+    """暫時性錯誤才值得重試、才計入斷路器；4xx 代表服務正常但請求有問題。"""
+    status = _status_of(exc)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(exc, RETRYABLE_EXCEPTIONS)
+
+
+def _backoff(attempt: int) -> float:
+    """指數退避加 full jitter。"""
+    return random.uniform(0, min(RESILIENCE_BACKOFF_CAP, RESILIENCE_BACKOFF_BASE * 2 ** attempt))
+
+
+def _should_retry(breaker: CircuitBreaker, exc: BaseException, last_attempt: bool) -> bool:
+    """記錄一次失敗的嘗試，回傳是否該重試。
+
+    取消（逾時、用戶端斷線）不算失敗；4xx 代表服務正常；只有暫時性錯誤計入斷路器。
+    """
+    if not isinstance(exc, Exception):
+        breaker.record_abandoned()
+        return False
+    if not is_retryable(exc):
+        breaker.record_success()
+        return False
+    if last_attempt or breaker.state == "half_open":
+        breaker.record_failure()
+        return False
+    breaker.stats["retries"] += 1
+    return True
+
+
+async def _call(name: str, func, args, kwargs, retries: int, settle: bool):
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise CircuitOpenError(f"{name} 暫時停用（連續失敗）")
+    for attempt in range(retries + 1):
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as e:
+            if not _should_retry(breaker, e, attempt == retries):
+                raise
+            await asyncio.sleep(_backoff(attempt))
+        else:
+            if settle:
+                breaker.record_success()
+            return result
+
+
+async def call_upstream(name: str, func, *args, retries: int = RESILIENCE_RETRIES, **kwargs):
+    """經過斷路器與重試呼叫非同步的外部服務。
+
+    Raises:
+        CircuitOpenError: 斷路器開啟中
+    """
+    return await _call(name, func, args, kwargs, retries, settle=True)
+
+
+async def stream_upstream(name: str, func, *args, retries: int = RESILIENCE_RETRIES, **kwargs):
+    """經過斷路器開啟串流（開啟時可重試），回傳逐段轉送的 async iterator。
+
+    整個串流讀完才算成功；中途的暫時性錯誤同樣計入斷路器，但已送出部分內容所以不重試。
+
+    Raises:
+        CircuitOpenError: 斷路器開啟中
+    """
+    stream = await _call(name, func, args, kwargs, retries, settle=False)
+    return _guard_stream(get_breaker(name), stream)
+
+
+async def _guard_stream(breaker: CircuitBreaker, stream):
+    try:
+        async for chunk in stream:
+            yield chunk
+    except BaseException as e:
+        _should_retry(breaker, e, last_attempt=True)
+        raise
+    breaker.record_success()
+
+
+def call_upstream_sync(name: str, func, *args, retries: int = RESILIENCE_RETRIES, **kwargs):
+    """call_upstream 的同步版本（給在執行緒池中執行的 SDK 呼叫）。"""
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise CircuitOpenError(f"{name} 暫時停用（連續失敗）")
+    for attempt in range(retries + 1):
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            if not _should_retry(breaker, e, attempt == retries):
+                raise
+            time.sleep(_backoff(attempt))
+        else:
+            breaker.record_success()
+            return result
+
+
+async def remember_good(upstream: str, key: str, data):
+    """記下最後一次成功取得的資料。"""
+    _last_good[(upstream, key)] = data
+    await run_write(save_last_known_good, upstream, key, data)
+
+
+async def last_good(upstream: str, key: str):
+    """取得最後已知的正確資料（先查記憶體），沒有時回傳 None。"""
+    data = _last_good.get((upstream, key))
+    if data is None:
+        stored = await run_read(get_last_known_good, upstream, key)
+        if stored is not None:
+            data = _last_good[(upstream, key)] = stored["data"]
+    return data
+
+
+def get_resilience_stats() -> dict:
+    """各外部服務的斷路器狀態與統計。"""
+    return {name: breaker.snapshot() for name, breaker in _breakers.items()}
@@ -0,0 +1,79 @@
+"""Single-flight：相同 key 的並發請求只執行一次，其餘請求等待同一個結果。
+
+同一個 worker 內以共用的 asyncio.Task 合併；跨 worker 則以 SQLite flight_locks 的鎖列協調，
+沒搶到鎖的 worker 輪詢 wait_for_peer（例如回應快取）直到領頭的 worker 寫入結果。
+"""
+import asyncio
+import os
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+from db_service import acquire_flight_lock, is_flight_locked, release_flight_lock, run_read, run_write
+
+load_dotenv()
+
+# 鎖的有效時間（秒），領頭的 worker 當掉時其他 worker 最久等這麼久就會接手
+SINGLE_FLIGHT_LOCK_TTL = float(os.getenv("SINGLE_FLIGHT_LOCK_TTL", "60"))
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.getenv("SINGLE_FLIGHT_POLL_INTERVAL", "0.2"))
+
+OWNER_PREFIX = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_inflight: dict[str, asyncio.Task] = {}
+_stats = {"leaders": 0, "followers": 0, "peer_waits": 0, "peer_hits": 0}
+
+
+async def _wait_for_peer(key: str, wait_for_peer) -> object | None:
+    """等待其他 worker 完成，回傳其結果；鎖消失或過期仍沒有結果時回傳 None。"""
+    _stats["peer_waits"] += 1
+    deadline = time.monotonic() + SINGLE_FLIGHT_LOCK_TTL
+    while time.monotonic() < deadline:
+        await asyncio.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+        result = await wait_for_peer()
+        if result is not None:
+            _stats["peer_hits"] += 1
+            return result
+        if not await run_read(is_flight_locked, key):
+            return None
+    return None
+
+
+async def _lead(key: str, factory, wait_for_peer):
+    owner = f"{OWNER_PREFIX}:{uuid.uuid4().hex[:8]}"
+    if wait_for_peer is not None and not await run_write(acquire_flight_lock, key, owner, SINGLE_FLIGHT_LOCK_TTL):
+        result = await _wait_for_peer(key, wait_for_peer)
+        if result is not None:
+            return result
+        # 領頭的 worker 失敗或逾時，改由自己執行（不再等待）
+        await run_write(acquire_flight_lock, key, owner, SINGLE_FLIGHT_LOCK_TTL)
+
+    _stats["leaders"] += 1
+    try:
+        return await factory()
+    finally:
+        if wait_for_peer is not None:
+            await run_write(release_flight_lock, key, owner)
+
+
+async def single_flight(key: str, factory, wait_for_peer=None):
+    """以 key 合併並發的 factory()（coroutine function）呼叫。
+
+    Args:
+        wait_for_peer: 跨 worker 合併用；回傳其他 worker 已完成的結果，尚未完成時回傳 None。
+            None 表示只在同一個 worker 內合併
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_lead(key, factory, wait_for_peer))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        _stats["followers"] += 1
+    # shield：發起請求的連線中斷時，其他等待者仍可拿到結果
+    return await asyncio.shield(task)
+
+
+def get_single_flight_stats() -> dict:
+    """合併請求的統計。"""
+    return {**_stats, "inflight": len(_inflight)}
@@ -0,0 +1,232 @@
+import asyncio
+import csv
+import os
+import sys
+import time
+import zlib
+from datetime import date
+from io import StringIO
+from typing import NamedTuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from sleep_service import SleepAnalysis, build_analysis
+from morning_cache_service import invalidate_morning_cache
+from db_service import clear_sleep_uploads, get_all_sleep_segments, run_read, run_write, save_sleep_records
+
+load_dotenv()
+
+# 兩段睡眠之間間隔超過幾小時就視為不同晚
+NIGHT_GAP_HOURS = float(os.getenv("SLEEP_NIGHT_GAP_HOURS", "3"))
+
+# 睡眠階段代碼，OTHER 代表 InBed 等不計入時數的紀錄（只影響起訖時間）
+STAGES = ("Core", "REM", "Deep", "Awake")
+STAGE_CODES = {name: code for code, name in enumerate(STAGES)}
+OTHER = len(STAGES)
+AWAKE = STAGE_CODES["Awake"]
+
+# 每晚的原始片段以 packed 結構陣列保存（每筆 13 bytes，再以 zlib 壓縮）：
+# 相對於當晚第一個片段的起訖秒數、時數（千分之一小時，CSV 本身只到小數第三位）、階段代碼
+SEGMENT_DTYPE = np.dtype([
+    ("start", "<u4"),
+    ("end", "<u4"),
+    ("duration_mhr", "<u4"),
+    ("stage", "u1"),
+])
+
+
+class Segments(NamedTuple):
+    """睡眠片段的欄位陣列（依 start 排序）。"""
+
+    start: np.ndarray  # int64，epoch 秒（naive 時間當作 UTC 處理）
+    end: np.ndarray  # int64，epoch 秒
+    duration_hr: np.ndarray  # float64
+    stage: np.ndarray  # uint8，STAGES 的索引或 OTHER
+
+
+def _wall_times(values) -> np.ndarray:
+    """將時間字串轉成當地牆上時間（naive）的 epoch 秒。"""
+    # 只取前 19 字元丟掉時區，否則 NumPy 會把 +08:00 換算成 UTC（同 health_import_service._to_epoch）
+    return np.array([value[:19] for value in values], dtype="datetime64[s]").astype(np.int64)
+
+
+def load_segments(csv_data: str) -> Segments:
+    """將 CSV 的 Start/End/Duration/Value 欄位載入成型別化陣列。"""
+    reader = csv.reader(StringIO(csv_data))
+    header = next(reader, None)
+    if header is None:
+        raise ValueError("沒有睡眠數據")
+
+    rows = [row for row in reader if row]
+    if not rows:
+        raise ValueError("沒有睡眠數據")
+    columns = list(zip(*rows))
+
+    start = _wall_times(columns[header.index("Start")])
+    end = _wall_times(columns[header.index("End")])
+    duration_hr = np.array(columns[header.index("Duration (hr)")], dtype=np.float64)
+    stage = np.array(
+        [STAGE_CODES.get(value, OTHER) for value in columns[header.index("Value")]],
+        dtype=np.uint8,
+    )
+
+    order = np.argsort(start, kind="stable")
+    return Segments(start[order], end[order], duration_hr[order], stage[order])
+
+
+def split_nights(segments: Segments, gap_hours: float = NIGHT_GAP_HOURS) -> np.ndarray:
+    """依片段之間的空檔切分成多晚，回傳每個片段所屬的晚次編號（0 起算）；同一天起床的會併成一晚。"""
+    if len(segments.start) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # 與「先前所有片段的最晚結束時間」比較，重疊的片段不會被切開
+    latest_end = np.maximum.accumulate(segments.end)
+    is_break = segments.start[1:] - latest_end[:-1] > gap_hours * 3600
+    night_ids = np.concatenate(([0], np.cumsum(is_break)))
+
+    # 紀錄以起床那天為 key：同一天起床的多段（午睡、中途醒來超過 gap_hours）併成同一晚，
+    # 否則會寫到同一個日期而互相覆蓋
+    boundaries = np.flatnonzero(np.diff(night_ids, prepend=-1))
+    wake_day = np.maximum.reduceat(segments.end, boundaries) // 86400
+    merged = np.concatenate(([0], np.cumsum(np.diff(wake_day) != 0)))
+    return merged[night_ids]
+
+
+def analyze_nights(segments: Segments, night_ids: np.ndarray | None = None) -> list[SleepAnalysis]:
+    """以分組陣列運算計算每晚的各階段時數與醒來次數，再套用評分規則。
+
+    Returns:
+        每晚一筆 SleepAnalysis，依時間排序
+    """
+    if night_ids is None:
+        night_ids = split_nights(segments)
+    if len(night_ids) == 0:
+        return []
+
+    nights = int(night_ids[-1]) + 1
+    width = OTHER + 1
+
+    # (晚次, 階段) 攤平成單一索引做 bincount
+    group = night_ids * width + segments.stage
+    hours = np.bincount(group, weights=segments.duration_hr, minlength=nights * width).reshape(nights, width)
+    counts = np.bincount(group, minlength=nights * width).reshape(nights, width)
+
+    # 各晚第一個片段的位置；start 已排序，end 用 reduceat 取最大值
+    boundaries = np.flatnonzero(np.diff(night_ids, prepend=-1))
+    sleep_start = segments.start[boundaries].astype("datetime64[s]")
+    sleep_end = np.maximum.reduceat(segments.end, boundaries).astype("datetime64[s]")
+
+    return [
+        build_analysis(
+            sleep_start=sleep_start[i].item(),
+            sleep_end=sleep_end[i].item(),
+            deep_hours=float(hours[i, STAGE_CODES["Deep"]]),
+            rem_hours=float(hours[i, STAGE_CODES["REM"]]),
+            core_hours=float(hours[i, STAGE_CODES["Core"]]),
+            awake_hours=float(hours[i, AWAKE]),
+            awake_count=int(counts[i, AWAKE]),
+        )
+        for i in range(nights)
+    ]
+
+
+def to_sleep_record(analysis: SleepAnalysis) -> dict:
+    """將 SleepAnalysis 轉成 db_service.save_sleep_records 的欄位。"""
+    return {
+        "sleep_date": analysis.sleep_end.date(),
+        **analysis.model_dump(),
+    }
+
+
+def pack_nights(segments: Segments, night_ids: np.ndarray | None = None) -> list[tuple[str, int, int, bytes]]:
+    """將片段依晚壓縮成 db_service.save_sleep_segments 的資料列。
+
+    Returns:
+        (date, base_ts, count, data) 列表，date 與 sleep_records 相同（起床那天）
+    """
+    if night_ids is None:
+        night_ids = split_nights(segments)
+    boundaries = np.flatnonzero(np.diff(night_ids, prepend=-1))
+    ends = np.append(boundaries[1:], len(night_ids))
+
+    rows = []
+    for lo, hi in zip(boundaries, ends):
+        base = int(segments.start[lo])
+        packed = np.empty(hi - lo, dtype=SEGMENT_DTYPE)
+        packed["start"] = segments.start[lo:hi] - base
+        packed["end"] = segments.end[lo:hi] - base
+        packed["duration_mhr"] = np.rint(segments.duration_hr[lo:hi] * 1000)
+        packed["stage"] = segments.stage[lo:hi]
+        night_date = np.datetime64(int(segments.end[lo:hi].max()), "s").item().date()
+        rows.append((night_date.isoformat(), base, int(hi - lo), zlib.compress(packed.tobytes())))
+    return rows
+
+
+def pack_sleep_csv(csv_data: str, single_night: bool = False) -> list[tuple[str, int, int, bytes]]:
+    """解析 CSV 並壓縮成每晚一列；single_night 時整份視為同一晚（/morning 的單晚上傳）。"""
+    segments = load_segments(csv_data)
+    night_ids = np.zeros(len(segments.start), dtype=np.int64) if single_night else None
+    return pack_nights(segments, night_ids)
+
+
+def analyze_and_pack(csv_data: str) -> tuple[list[SleepAnalysis], list[tuple[str, int, int, bytes]]]:
+    """批次分析多晚 CSV，同時產生要保存的壓縮片段，只解析一次。"""
+    segments = load_segments(csv_data)
+    night_ids = split_nights(segments)
+    return analyze_nights(segments, night_ids), pack_nights(segments, night_ids)
+
+
+def unpack_nights(rows: list[dict]) -> tuple[Segments, np.ndarray]:
+    """將多晚的壓縮片段還原成一組 Segments 與對應的晚次編號。"""
+    parts = [np.frombuffer(zlib.decompress(row["data"]), dtype=SEGMENT_DTYPE) for row in rows]
+    if not parts:
+        empty = np.zeros(0, dtype=np.int64)
+        return Segments(empty, empty, np.zeros(0), np.zeros(0, dtype=np.uint8)), empty
+
+    packed = np.concatenate(parts)
+    counts = np.array([len(part) for part in parts])
+    base = np.repeat(np.array([row["base_ts"] for row in rows], dtype=np.int64), counts)
+    night_ids = np.repeat(np.arange(len(parts)), counts)
+    segments = Segments(
+        start=base + packed["start"],
+        end=base + packed["end"],
+        duration_hr=packed["duration_mhr"] / 1000,
+        stage=packed["stage"],
+    )
+    return segments, night_ids
+
+
+def rescore_nights(rows: list[dict]) -> list[dict]:
+    """以目前的評分規則重新計算已儲存片段的夜晚，回傳 save_sleep_records 的資料列。"""
+    segments, night_ids = unpack_nights(rows)
+    results = analyze_nights(segments, night_ids)
+    return [
+        {**to_sleep_record(analysis), "sleep_date": date.fromisoformat(row["date"])}
+        for row, analysis in zip(rows, results)
+    ]
+
+
+async def rescore_all_nights() -> dict:
+    """重新計算所有已儲存片段的夜晚，經由 DB 寫入執行緒批次更新 sleep_records。
+
+    先前快取的 CSV 分析結果與早安回應都是舊評分，一併清除。
+
+    Returns:
+        處理的晚數與耗時
+    """
+    started = time.perf_counter()
+    rows = await run_read(get_all_sleep_segments)
+    records = await asyncio.to_thread(rescore_nights, rows)
+    saved = await run_write(save_sleep_records, records) if records else 0
+    if saved:
+        await run_write(clear_sleep_uploads)
+        await invalidate_morning_cache()
+    return {"nights": len(records), "saved": saved, "elapsed": round(time.perf_counter() - started, 3)}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["rescore"]:
+        print(asyncio.run(rescore_all_nights()))
+    else:
+        print("用法：python sleep_batch_service.py rescore")
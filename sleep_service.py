@@ -1,9 +1,14 @@
+import asyncio
 import csv
+import hashlib
+from collections.abc import Iterable
 from datetime import datetime
 from io import StringIO
 from typing import Annotated
 from pydantic import BaseModel, PlainSerializer
 
+from db_service import count_sleep_uploads, get_sleep_upload, run_read
+
 
 # 用 Annotated 讓 float 序列化時只保留 2 位小數
 Float2 = Annotated[float, PlainSerializer(lambda x: round(x, 2), return_type=float)]
@@ -47,7 +52,80 @@ def parse_csv(csv_data: str) -> list[SleepRecord]:
 
 def analyze_sleep(csv_data: str) -> SleepAnalysis:
     """分析睡眠數據。"""
-    records = parse_csv(csv_data)
+    return analyze_sleep_stream(StringIO(csv_data))
+
+
+def analyze_sleep_stream(lines: Iterable[str]) -> SleepAnalysis:
+    """逐列讀取 CSV 並一次累計各階段時數、醒來次數與起訖時間。
+
+    不建立每列的 SleepRecord，適合數萬列的長時間匯出。
+
+    Args:
+        lines: CSV 的逐行內容（字串、檔案或任何可迭代的行）
+    """
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        raise ValueError("沒有睡眠數據")
+
+    i_start = header.index("Start")
+    i_end = header.index("End")
+    i_duration = header.index("Duration (hr)")
+    i_value = header.index("Value")
+
+    # 各階段的累計與 Neumaier 補償值，與內建 sum() 的結果完全一致
+    stage_index = {"Deep": 0, "REM": 1, "Core": 2, "Awake": 3}
+    totals = [0.0, 0.0, 0.0, 0.0]
+    compensations = [0.0, 0.0, 0.0, 0.0]
+    awake_count = 0
+    sleep_start = sleep_end = None
+    parse = datetime.fromisoformat
+
+    for row in reader:
+        if not row:
+            continue
+        i = stage_index.get(row[i_value])
+        if i is not None:
+            x = float(row[i_duration])
+            total = totals[i]
+            t = total + x
+            if abs(total) >= abs(x):
+                compensations[i] += (total - t) + x
+            else:
+                compensations[i] += (x - t) + total
+            totals[i] = t
+            if i == 3:
+                awake_count += 1
+
+        start = parse(row[i_start])
+        end = parse(row[i_end])
+        if sleep_start is None:
+            sleep_start, sleep_end = start, end
+        else:
+            if start < sleep_start:
+                sleep_start = start
+            if end > sleep_end:
+                sleep_end = end
+
+    if sleep_start is None:
+        raise ValueError("沒有睡眠數據")
+
+    deep_hours, rem_hours, core_hours, awake_hours = (
+        total + compensation for total, compensation in zip(totals, compensations)
+    )
+    return build_analysis(
+        sleep_start=sleep_start,
+        sleep_end=sleep_end,
+        deep_hours=deep_hours,
+        rem_hours=rem_hours,
+        core_hours=core_hours,
+        awake_hours=awake_hours,
+        awake_count=awake_count,
+    )
+
+
+def analyze_records(records: list[SleepRecord]) -> SleepAnalysis:
+    """分析已解析的 SleepRecord 列表。"""
     if not records:
         raise ValueError("沒有睡眠數據")
 
@@ -58,12 +136,30 @@ def analyze_sleep(csv_data: str) -> SleepAnalysis:
     awake_hours = sum(r.duration_hr for r in records if r.value == "Awake")
     awake_count = sum(1 for r in records if r.value == "Awake")
 
+    return build_analysis(
+        sleep_start=min(r.start for r in records),
+        sleep_end=max(r.end for r in records),
+        deep_hours=deep_hours,
+        rem_hours=rem_hours,
+        core_hours=core_hours,
+        awake_hours=awake_hours,
+        awake_count=awake_count,
+    )
+
+
+def build_analysis(
+    sleep_start: datetime,
+    sleep_end: datetime,
+    deep_hours: float,
+    rem_hours: float,
+    core_hours: float,
+    awake_hours: float,
+    awake_count: int,
+) -> SleepAnalysis:
+    """由各階段時數套用評分規則，產生 SleepAnalysis。"""
     total_hours = deep_hours + rem_hours + core_hours + awake_hours
     actual_sleep_hours = deep_hours + rem_hours + core_hours
 
-    sleep_start = min(r.start for r in records)
-    sleep_end = max(r.end for r in records)
-
     # 睡眠效率
     sleep_efficiency = actual_sleep_hours / total_hours if total_hours > 0 else 0
 
@@ -111,6 +207,59 @@ def analyze_sleep(csv_data: str) -> SleepAnalysis:
     )
 
 
+# 重複上傳（捷徑重試、逾時後再按一次）的命中統計
+_upload_stats = {"hits": 0, "misses": 0}
+
+
+def fingerprint_csv(csv_data: str) -> str:
+    """以正規化後（統一換行、去除頭尾空白）的 CSV 內容計算 SHA-256。"""
+    normalized = csv_data.replace("\r\n", "\n").strip()
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+async def analyze_sleep_cached(csv_data: str) -> tuple[SleepAnalysis, dict]:
+    """分析睡眠 CSV；同樣內容已處理過時直接回傳先前的結果，不重新解析。
+
+    Returns:
+        (analysis, upload)，upload 包含 content_hash、hit、record_saved；
+        未命中時由呼叫端決定是否以 db_service.save_sleep_upload 記錄
+    """
+    content_hash = fingerprint_csv(csv_data)
+    stored = await run_read(get_sleep_upload, content_hash)
+    if stored:
+        _upload_stats["hits"] += 1
+        analysis = SleepAnalysis.model_validate_json(stored["analysis"])
+        return analysis, {"content_hash": content_hash, "hit": True, "record_saved": stored["record_saved"]}
+
+    _upload_stats["misses"] += 1
+    analysis = await asyncio.to_thread(analyze_sleep, csv_data)
+    return analysis, {"content_hash": content_hash, "hit": False, "record_saved": False}
+
+
+async def get_sleep_upload_stats() -> dict:
+    """取得重複上傳的命中統計。"""
+    lookups = _upload_stats["hits"] + _upload_stats["misses"]
+    return {
+        **_upload_stats,
+        "hit_rate": round(_upload_stats["hits"] / lookups, 3) if lookups else 0.0,
+        "stored": await run_read(count_sleep_uploads),
+    }
+
+
+def format_sleep_trend(stats: dict) -> str:
+    """將 db_service.get_sleep_stats 的結果整理成 prompt 用的趨勢摘要。"""
+    lines = []
+    for window, w in stats["windows"].items():
+        if not w["nights"]:
+            continue
+        lines.append(
+            f"- 近 {window} 天：平均 {w['avg_sleep_hours']:.1f} 小時，"
+            f"睡眠負債 {w['sleep_debt_hours']:.1f} 小時，"
+            f"{w['late_night_ratio'] * 100:.0f}% 的晚上 02:00 後才睡"
+        )
+    return "\n".join(lines)
+
+
 if __name__ == "__main__":
     csv_data = """Start,End,Duration (hr),Value,Source
 2025-12-04 03:17:09,2025-12-04 03:18:09,0.017,Core,Tsung-Hua的Apple Watch
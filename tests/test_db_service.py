@@ -0,0 +1,77 @@
+import asyncio
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+import db_service
+
+
+def _bad_write():
+    with db_service.write_transaction() as conn:
+        conn.execute("INSERT INTO no_such_table VALUES (1)")
+
+
+def _slow_write():
+    with db_service.write_transaction() as conn:
+        conn.execute("SELECT 1")
+        time.sleep(0.5)
+
+
+def _trivial_read():
+    with db_service.get_connection() as conn:
+        return conn.execute("SELECT 1").fetchone()[0]
+
+
+class GroupCommitTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._db_path = db_service.DB_PATH
+        db_service.DB_PATH = Path(self._tmp.name) / "assistant.db"
+        # 匯入時已連到預設的資料庫，改用暫存資料庫前先關掉
+        db_service.close_connection()
+        db_service._db_executor.submit(db_service.close_connection).result()
+        db_service.init_db()
+
+    def tearDown(self):
+        db_service._db_executor.submit(db_service.close_connection).result()
+        db_service.close_connection()
+        db_service.DB_PATH = self._db_path
+        self._tmp.cleanup()
+
+    def test_failing_write_does_not_roll_back_batch(self):
+        """同一批次中間一筆寫入失敗，前後兩筆仍要 commit。"""
+        async def run():
+            return await asyncio.gather(
+                db_service.run_write(db_service.save_last_known_good, "test", "a", 1),
+                db_service.run_write(_bad_write),
+                db_service.run_write(db_service.save_last_known_good, "test", "b", 2),
+                return_exceptions=True,
+            )
+
+        first, bad, last = asyncio.run(run())
+        self.assertIs(first, True)
+        self.assertIsInstance(bad, db_service.sqlite3.OperationalError)
+        self.assertIn("no_such_table", str(bad))
+        self.assertIs(last, True)
+        self.assertEqual(db_service.get_last_known_good("test", "a")["data"], 1)
+        self.assertEqual(db_service.get_last_known_good("test", "b")["data"], 2)
+
+    def test_read_does_not_wait_for_write_batch(self):
+        """查詢不排在進行中的寫入批次後面。"""
+        async def run():
+            write = asyncio.ensure_future(db_service.run_write(_slow_write))
+            await asyncio.sleep(0.05)
+            started = time.perf_counter()
+            value = await db_service.run_read(_trivial_read)
+            elapsed = time.perf_counter() - started
+            await write
+            return value, elapsed
+
+        value, elapsed = asyncio.run(run())
+        self.assertEqual(value, 1)
+        self.assertLess(elapsed, 0.2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,34 @@
+import asyncio
+import json
 import os
+import time
+from datetime import date
+
 from dotenv import load_dotenv
 from todoist_api_python.api import TodoistAPI
 from todoist_api_python.models import Task
 
+from http_service import get_http_client
+from resilience_service import call_upstream
+from db_service import (
+    apply_todoist_changes,
+    get_todoist_items,
+    get_todoist_sync_state,
+    run_read,
+    run_write,
+)
+
 load_dotenv()
 
-api = TodoistAPI(os.getenv("TODOIST_API_TOKEN"))
+TODOIST_API_TOKEN = os.getenv("TODOIST_API_TOKEN")
+api = TodoistAPI(TODOIST_API_TOKEN)
+
+# 本地鏡像：超過幾秒沒同步就先增量同步再讀取
+SYNC_URL = "https://api.todoist.com/api/v1/sync"
+TODOIST_SYNC_MAX_AGE = float(os.getenv("TODOIST_SYNC_MAX_AGE", "300"))
+
+# 同一個 process 內同時只跑一個同步
+_sync_lock = asyncio.Lock()
 
 
 def get_tasks(filter_query: str | None = None) -> list[Task]:
@@ -18,7 +41,7 @@ def get_tasks(filter_query: str | None = None) -> list[Task]:
         待辦事項列表
     """
     if filter_query:
-        paginator = api.get_tasks(filter=filter_query)
+        paginator = api.filter_tasks(query=filter_query)
     else:
         paginator = api.get_tasks()
 
@@ -34,6 +57,110 @@ def get_today_tasks() -> list[Task]:
     return get_tasks(filter_query="today | overdue")
 
 
+def _to_local_item(item: dict) -> dict:
+    """將 Sync API 的 item 轉成本地表格的欄位。"""
+    due = item.get("due") or {}
+    return {
+        "id": item["id"],
+        "content": item.get("content", ""),
+        "priority": item.get("priority", 1),
+        "due_date": due.get("date", "")[:10] or None,
+        "project_id": item.get("project_id"),
+        "child_order": item.get("child_order", 0),
+        "updated_at": item.get("updated_at"),
+    }
+
+
+async def _request_sync(sync_token: str) -> dict:
+    client = get_http_client()
+    resp = await client.post(
+        SYNC_URL,
+        headers={"Authorization": f"Bearer {TODOIST_API_TOKEN}"},
+        data={
+            "sync_token": sync_token,
+            "resource_types": json.dumps(["items"]),
+        },
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+
+async def sync_todoist(force: bool = False) -> dict:
+    """以 Sync API 的 sync token 增量同步待辦到本地 SQLite。
+
+    第一次用 sync_token="*" 做完整同步，之後只傳輸有變動的 item。
+    已完成或已刪除的待辦會從本地移除。
+
+    Args:
+        force: 忽略 TODOIST_SYNC_MAX_AGE，立即同步
+
+    Returns:
+        同步結果統計
+    """
+    async with _sync_lock:
+        state = await run_read(get_todoist_sync_state)
+        if state and not force and time.time() - state["synced_at"] < TODOIST_SYNC_MAX_AGE:
+            return {"skipped": True}
+
+        data = await call_upstream("todoist", _request_sync, state["sync_token"] if state else "*")
+
+        items = data.get("items", [])
+        upserts = [
+            _to_local_item(item)
+            for item in items
+            if not item.get("checked") and not item.get("is_deleted")
+        ]
+        deleted_ids = [
+            item["id"] for item in items if item.get("checked") or item.get("is_deleted")
+        ]
+        full_sync = data.get("full_sync", state is None)
+
+        await run_write(
+            apply_todoist_changes,
+            upserts,
+            deleted_ids,
+            sync_token=data["sync_token"],
+            synced_at=time.time(),
+            full_sync=full_sync,
+        )
+        return {"full_sync": full_sync, "upserted": len(upserts), "deleted": len(deleted_ids)}
+
+
+async def _ensure_synced(refresh: bool) -> str | None:
+    """必要時同步；失敗但本地已有資料時沿用本地的，並回傳失敗原因。"""
+    try:
+        await sync_todoist(force=refresh)
+    except Exception as e:
+        if not await run_read(get_todoist_sync_state):
+            raise
+        return f"Todoist 同步失敗，使用先前的資料：{e}"
+    return None
+
+
+async def get_mirrored_tasks(refresh: bool = False) -> list[dict]:
+    """從本地鏡像取得所有未完成待辦。
+
+    Args:
+        refresh: 強制先同步一次
+    """
+    await _ensure_synced(refresh)
+    return await run_read(get_todoist_items)
+
+
+async def get_briefing_tasks_with_status(limit: int = 5, refresh: bool = False) -> tuple[list[dict], str | None]:
+    """從本地鏡像取得今日與過期的待辦，依優先度、到期日排序取前 N 個。
+
+    Args:
+        limit: 要取的數量
+        refresh: 強制先同步一次
+
+    Returns:
+        (待辦列表, 同步失敗原因；成功時為 None)
+    """
+    failure = await _ensure_synced(refresh)
+    return await run_read(get_todoist_items, due_on_or_before=date.today(), limit=limit), failure
+
+
 if __name__ == "__main__":
     tasks = get_tasks()
     print(f"共 {len(tasks)} 個待辦事項:\n")
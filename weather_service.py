@@ -1,15 +1,52 @@
+import asyncio
 import os
+import time
 from dotenv import load_dotenv
-import httpx
+
+from http_service import get_http_client, close_http_client
+from db_service import get_weather_cache, save_weather_cache, save_weather_cache_many, run_read, run_write
+from resilience_service import call_upstream, last_good, remember_good
 
 load_dotenv()
 
 CWA_API_KEY = os.getenv("CWA_API_KEY")
 BASE_URL = "https://opendata.cwa.gov.tw/api/v1/rest/datastore"
 
+# 快取 TTL（秒）：F-C0032-001 每幾小時才更新一次
+WEATHER_CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", "1800"))
+WEATHER_NOT_FOUND_TTL = float(os.getenv("WEATHER_NOT_FOUND_TTL", "300"))
+WEATHER_ERROR_TTL = float(os.getenv("WEATHER_ERROR_TTL", "60"))
+# 過期後仍可先回傳舊資料的最長時間，超過就必須等待重新取得
+WEATHER_MAX_STALE = float(os.getenv("WEATHER_MAX_STALE", "21600"))
+# 快照模式：一次抓全部縣市，所有地點共用同一次 API 呼叫
+WEATHER_SNAPSHOT_MODE = os.getenv("WEATHER_SNAPSHOT_MODE", "true").lower() in ("1", "true", "yes")
+SNAPSHOT_KEY = "__snapshot__"
+
+# 記憶體快取：location -> (data, expires_at)
+_cache: dict[str, tuple[dict, float]] = {}
+# 進行中的刷新，避免同一地點重複打 API
+_refreshing: dict[str, asyncio.Task] = {}
+# 刷新失敗但仍有舊資料的地點：location -> 下次可重試的時間
+_retry_after: dict[str, float] = {}
+# 最近一次全縣市快照：location -> 天氣資訊 dict
+_snapshot: dict = {"index": {}, "fetched_at": 0.0}
+
+_stats = {
+    "hits": 0,
+    "stale_hits": 0,
+    "misses": 0,
+    "refreshes": 0,
+    "snapshot_refreshes": 0,
+    "upstream_errors": 0,
+    "kept_on_error": 0,
+}
+
 
 async def get_weather(location: str = "新竹縣") -> dict:
-    """取得天氣預報。
+    """取得天氣預報（有快取）。
+
+    快取未過期直接回傳；過期但仍在 WEATHER_MAX_STALE 內時先回傳舊資料，
+    並在背景重新取得。刷新失敗後的 WEATHER_ERROR_TTL 內繼續回傳舊資料，不重試。
 
     Args:
         location: 縣市名稱，例如 "新竹縣"、"新竹市"、"台北市"
@@ -17,45 +54,194 @@ async def get_weather(location: str = "新竹縣") -> dict:
     Returns:
         天氣資訊 dict
     """
-    # F-C0032-001: 一般天氣預報-今明 36 小時天氣預報
-    url = f"{BASE_URL}/F-C0032-001"
-    params = {
-        "Authorization": CWA_API_KEY,
-        "locationName": location,
+    now = time.time()
+    entry = _cache.get(location)
+    if entry is None:
+        stored = await run_read(get_weather_cache, location)
+        if stored:
+            entry = (stored["data"], stored["expires_at"])
+            _cache[location] = entry
+
+    if entry:
+        data, expires_at = entry
+        if now < expires_at:
+            _stats["hits"] += 1
+            return data
+        retry_after = _retry_after.get(location, 0.0)
+        if now - expires_at < WEATHER_MAX_STALE or now < retry_after:
+            _stats["stale_hits"] += 1
+            if now >= retry_after:
+                _start_refresh(location)
+            return data
+
+    _stats["misses"] += 1
+    # shield：呼叫端逾時取消時，刷新仍會完成並寫入快取
+    return await asyncio.shield(_start_refresh(location))
+
+
+async def get_last_known_weather(location: str) -> dict | None:
+    """取得最後一次成功的天氣資料（不論多舊），沒有時回傳 None。"""
+    return await last_good("cwa", location)
+
+
+def _start_task(key: str, factory) -> asyncio.Task:
+    """啟動（或沿用進行中的）背景工作，同一 key 同時只會有一個。"""
+    task = _refreshing.get(key)
+    if task is None or task.done():
+        task = asyncio.create_task(factory())
+        _refreshing[key] = task
+        task.add_done_callback(lambda _: _refreshing.pop(key, None))
+    return task
+
+
+def _start_refresh(location: str) -> asyncio.Task:
+    return _start_task(location, lambda: _refresh(location))
+
+
+async def _refresh(location: str) -> dict:
+    """重新取得天氣並寫入快取，依結果決定 TTL。
+
+    外部服務失敗時若已有正確的舊資料，保留舊資料、只記下重試時間；
+    沒有可用的資料時才把錯誤寫入快取（WEATHER_ERROR_TTL）。
+    """
+    _stats["refreshes"] += 1
+    try:
+        if WEATHER_SNAPSHOT_MODE:
+            if time.time() - _snapshot["fetched_at"] < WEATHER_CACHE_TTL:
+                index = _snapshot["index"]
+            else:
+                index = await asyncio.shield(_start_task(SNAPSHOT_KEY, _refresh_snapshot))
+            # CWA 使用「臺」，讓「台北市」也能查到
+            data = index.get(location) or index.get(location.replace("台", "臺"))
+            if data is None:
+                data = {"error": f"找不到 {location} 的天氣資料"}
+        else:
+            data = await fetch_weather(location)
+        ttl = WEATHER_NOT_FOUND_TTL if "error" in data else WEATHER_CACHE_TTL
+        if "error" not in data:
+            await remember_good("cwa", location, data)
+    except Exception as e:
+        _stats["upstream_errors"] += 1
+        entry = _cache.get(location)
+        if entry and "error" not in entry[0]:
+            _stats["kept_on_error"] += 1
+            _retry_after[location] = time.time() + WEATHER_ERROR_TTL
+            return entry[0]
+        data = {"error": f"天氣資料取得失敗：{e}"}
+        ttl = WEATHER_ERROR_TTL
+
+    _retry_after.pop(location, None)
+    expires_at = time.time() + ttl
+    _cache[location] = (data, expires_at)
+    await run_write(save_weather_cache, location, data, expires_at)
+    return data
+
+
+async def _refresh_snapshot() -> dict[str, dict]:
+    """一次取得全部縣市，並寫入每個地點的快取。"""
+    _stats["snapshot_refreshes"] += 1
+    index = await fetch_weather_snapshot()
+
+    expires_at = time.time() + WEATHER_CACHE_TTL
+    for location, data in index.items():
+        _cache[location] = (data, expires_at)
+    await run_write(
+        save_weather_cache_many,
+        [(location, data, expires_at) for location, data in index.items()],
+    )
+
+    _snapshot["index"] = index
+    _snapshot["fetched_at"] = time.time()
+    return index
+
+
+async def get_weather_many(locations: list[str]) -> dict[str, dict]:
+    """取得多個地點的天氣，快照模式下最多只打一次 API。"""
+    results = await asyncio.gather(*(get_weather(location) for location in locations))
+    return dict(zip(locations, results))
+
+
+def get_weather_cache_stats() -> dict:
+    """取得天氣快取的命中統計。"""
+    lookups = _stats["hits"] + _stats["stale_hits"] + _stats["misses"]
+    return {
+        **_stats,
+        "hit_rate": round((_stats["hits"] + _stats["stale_hits"]) / lookups, 3) if lookups else 0.0,
+        "entries": len(_cache),
+        "snapshot_mode": WEATHER_SNAPSHOT_MODE,
+        "snapshot_locations": len(_snapshot["index"]),
     }
 
-    async with httpx.AsyncClient(verify=False) as client:
-        resp = await client.get(url, params=params, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
+
+async def _request_forecast(params: dict) -> list[dict]:
+    """呼叫 F-C0032-001（經過斷路器與重試），回傳 location 列表。"""
+    return await call_upstream("cwa", _get_forecast, params)
+
+
+async def _get_forecast(params: dict) -> list[dict]:
+    # F-C0032-001: 一般天氣預報-今明 36 小時天氣預報
+    url = f"{BASE_URL}/F-C0032-001"
+    client = get_http_client()
+    resp = await client.get(url, params={"Authorization": CWA_API_KEY, **params})
+    resp.raise_for_status()
+    data = resp.json()
 
     records = data.get("records", {})
-    locations = records.get("location", [])
+    return records.get("location", [])
 
-    if not locations:
-        return {"error": f"找不到 {location} 的天氣資料"}
 
-    loc = locations[0]
-    weather_elements = {e["elementName"]: e for e in loc["weatherElement"]}
+def _parse_location(loc: dict) -> dict:
+    """將單一 location 的 weatherElement 整理成天氣資訊 dict。"""
+    # 各項天氣資訊取第一個時段：element -> parameterName
+    elements = {}
+    for e in loc.get("weatherElement", []):
+        times = e.get("time") or [{}]
+        elements[e["elementName"]] = times[0].get("parameter", {}).get("parameterName", "")
 
-    # 取得各項天氣資訊（取第一個時段）
-    wx = weather_elements.get("Wx", {}).get("time", [{}])[0]  # 天氣現象
-    pop = weather_elements.get("PoP", {}).get("time", [{}])[0]  # 降雨機率
-    min_t = weather_elements.get("MinT", {}).get("time", [{}])[0]  # 最低溫
-    max_t = weather_elements.get("MaxT", {}).get("time", [{}])[0]  # 最高溫
-    ci = weather_elements.get("CI", {}).get("time", [{}])[0]  # 舒適度
+    wx = elements.get("Wx", "")  # 天氣現象
+    pop = elements.get("PoP", "")  # 降雨機率
+    min_t = elements.get("MinT", "")  # 最低溫
+    max_t = elements.get("MaxT", "")  # 最高溫
+    ci = elements.get("CI", "")  # 舒適度
 
     return {
-        "location": location,
-        "description": wx.get("parameter", {}).get("parameterName", ""),
-        "rain_probability": pop.get("parameter", {}).get("parameterName", ""),
-        "min_temp": min_t.get("parameter", {}).get("parameterName", ""),
-        "max_temp": max_t.get("parameter", {}).get("parameterName", ""),
-        "comfort": ci.get("parameter", {}).get("parameterName", ""),
-        "summary": f"{wx.get('parameter', {}).get('parameterName', '')}，{min_t.get('parameter', {}).get('parameterName', '')}~{max_t.get('parameter', {}).get('parameterName', '')}°C，降雨機率 {pop.get('parameter', {}).get('parameterName', '')}%",
+        "location": loc.get("locationName", ""),
+        "description": wx,
+        "rain_probability": pop,
+        "min_temp": min_t,
+        "max_temp": max_t,
+        "comfort": ci,
+        "summary": f"{wx}，{min_t}~{max_t}°C，降雨機率 {pop}%",
     }
 
 
+async def fetch_weather_snapshot() -> dict[str, dict]:
+    """一次取得全部縣市的天氣預報，並依地點建立索引（不經快取）。
+
+    Returns:
+        location -> 天氣資訊 dict
+    """
+    locations = await _request_forecast({})
+    return {loc["locationName"]: _parse_location(loc) for loc in locations}
+
+
+async def fetch_weather(location: str) -> dict:
+    """直接向 CWA 取得單一地點的天氣預報（不經快取）。
+
+    Args:
+        location: 縣市名稱，例如 "新竹縣"、"新竹市"、"台北市"
+
+    Returns:
+        天氣資訊 dict
+    """
+    locations = await _request_forecast({"locationName": location})
+
+    if not locations:
+        return {"error": f"找不到 {location} 的天氣資料"}
+
+    return {**_parse_location(locations[0]), "location": location}
+
+
 if __name__ == "__main__":
     import asyncio
 
@@ -67,5 +253,6 @@ if __name__ == "__main__":
         print(f"降雨機率: {weather.get('rain_probability')}%")
         print(f"舒適度: {weather.get('comfort')}")
         print(f"總結: {weather.get('summary')}")
+        await close_http_client()
 
     asyncio.run(main())